@@ -0,0 +1,505 @@
+"""
+Throughput benchmarks for the datafeed decrypt/parse path.
+
+None of these need a configured Django project, and only api and pipeline
+need Django installed.  Run them from the app directory:
+
+  python benchmarks.py rc4 [--size=BYTES] [--repeat=N]
+  python benchmarks.py parse [--counts=1000,10000,100000] [--legacy-max=N]
+  python benchmarks.py ksa [--size=BYTES] [--calls=N] [--keys=N]
+  python benchmarks.py api [--calls=N] [--connect-delay=SECONDS]
+  python benchmarks.py pipeline [--transactions=N] [--details=N] [--options=N]
+                                [--custom-fields=N] [--seed=N] [--payload=FILE]
+                                [--output=FILE]
+  python benchmarks.py generate [same feed options] --output=FILE
+  python benchmarks.py parallel [feed options] [--processes=1,2,4,8]
+  python benchmarks.py export [feed options]
+  python benchmarks.py projection [feed options] [--fields="id,customer_id;items"]
+
+pipeline times each stage of handling a datafeed on a generated feed (or
+the payload saved by generate) and can save the results as JSON for
+comparing versions.
+"""
+
+import os
+import sys
+import json
+import time
+import codecs
+import random
+import tempfile
+import subprocess
+import urllib
+import urllib2
+import argparse
+import platform
+import multiprocessing
+import resource
+from datetime import datetime, timedelta
+from xml.dom.minidom import parseString
+from xml.sax.saxutils import escape
+
+from foxyutils import ARC4, FastARC4, FoxyData, FeedParser, numpy, parse_parallel, \
+  PARALLEL_MIN_SIZE
+from foxyexport import export_transactions, revenue_by_product, counts_by_date
+
+# Same fixture and key as tests.FoxyDataVectorTest
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "fixtures", "testdata.xml")
+SECRET_KEY = 'abc123akp8ak7898a,.aoeueaouaoeuaoeu'
+
+
+def load_fixture(size=None):
+  f = codecs.open(FIXTURE, encoding='UTF-8', mode="r")
+  data = f.read().encode('utf-8')
+  f.close()
+  if size:
+    data = (data * (size // len(data) + 1))[:size]
+  return data
+
+
+def make_feed(count):
+  """
+  Build a feed of `count` copies of the fixture transaction, each with its
+  own id.
+  """
+  markup = load_fixture()
+  head, rest = markup.split('<transaction>', 1)
+  body, tail = rest.split('</transaction>', 1)
+  body = body.replace('<id>616</id>', '<id>%d</id>')
+  return ''.join([head] +
+                 ['<transaction>' + body % (i + 1) + '</transaction>' for i in xrange(count)] +
+                 [tail])
+
+
+FIRST_NAMES = ['John', 'Jane', 'Alex', 'Maria', 'Wei', 'Olu', u'Ren\xe9e']
+LAST_NAMES = ['Doe', 'Smith', 'Garcia', 'Chen', 'Okafor', u'M\xfcller']
+CITIES = [('Any City', 'TN', '37013'), ('Portland', 'OR', '97201'),
+          ('Austin', 'TX', '73301'), ('Boston', 'MA', '02108')]
+OPTIONS = [('color', ['red', 'blue', 'green']), ('size', ['S', 'M', 'L', 'XL']),
+           ('material', ['cotton', 'wool']), ('engraving', ['', 'Happy birthday & more'])]
+
+def generate_feed(transactions, details = 1, options = 1, custom_fields = 2, seed = 0):
+  """
+  A FoxyCart 0.7 schema datafeed with `transactions` transactions, each with
+  `details` products of `options` options and `custom_fields` custom
+  fields.  The same arguments always give the same feed.
+  """
+  rnd = random.Random(seed)
+  start = datetime(2012, 1, 1)
+  def tag(name, value):
+    return u'<%s>%s</%s>' % (name, escape(unicode(value)), name)
+
+  out = [u"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n<foxydata>",
+         tag('datafeed_version', 'XML FoxyCart Version 0.7'), u'<transactions>']
+  for i in xrange(transactions):
+    first, last = rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+    city, state, postal_code = rnd.choice(CITIES)
+    date = start + timedelta(seconds=rnd.randint(0, 365 * 86400))
+    products = []
+    total = 0
+    for d in xrange(details):
+      price = rnd.randint(100, 20000) / 100.0
+      quantity = rnd.randint(1, 5)
+      total += price * quantity
+      subscription = date.date() + timedelta(days=rnd.randint(0, 60))
+      products.append(u''.join(
+        [u'<transaction_detail>', tag('product_name', 'Product %d' % d),
+         tag('product_price', '%.2f' % price), tag('product_quantity', quantity),
+         tag('product_weight', '%.2f' % (rnd.random() * 5)),
+         tag('product_code', 'sku%05d' % rnd.randint(0, 9999)),
+         tag('subscription_frequency', rnd.choice(['', '1m', '2w'])),
+         tag('subscription_startdate', subscription.strftime(FoxyData.DateFmt)),
+         tag('next_transaction_date',
+             (subscription + timedelta(days=30)).strftime(FoxyData.DateFmt)),
+         tag('shipto', u'%s %s' % (first, last)),
+         tag('category_description', 'Default for all products'),
+         tag('category_code', 'DEFAULT'), tag('product_delivery_type', 'shipped'),
+         u'<transaction_detail_options>'] +
+        [u''.join([u'<transaction_detail_option>', tag('product_option_name', name),
+                   tag('product_option_value', rnd.choice(values)),
+                   u'<price_mod></price_mod><weight_mod></weight_mod>',
+                   u'</transaction_detail_option>'])
+         for name, values in (OPTIONS[o % len(OPTIONS)] for o in xrange(options))] +
+        [u'</transaction_detail_options></transaction_detail>']))
+    shipping = rnd.randint(0, 2000) / 100.0
+    out.extend([
+      u'<transaction>', tag('id', 1000 + i),
+      tag('transaction_date', date.strftime(FoxyData.DateTimeFmt)),
+      tag('customer_id', rnd.randint(1, transactions // 2 + 1)),
+      tag('customer_first_name', first), tag('customer_last_name', last),
+      tag('customer_address1', '%d Any Street' % rnd.randint(1, 99999)),
+      tag('customer_address2', ''), tag('customer_city', city),
+      tag('customer_state', state), tag('customer_postal_code', postal_code),
+      tag('customer_country', 'US'), tag('customer_phone', '(123) 456-7890'),
+      tag('customer_email', '%s.%s%d@example.com' % (first, last, i)),
+      tag('customer_ip', '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255),
+                                          rnd.randint(0, 255))),
+      tag('shipping_service_description', 'UPS: Ground'),
+      tag('product_total', '%.2f' % total), tag('tax_total', '0.00'),
+      tag('shipping_total', '%.2f' % shipping),
+      tag('order_total', '%.2f' % (total + shipping)),
+      u'<custom_fields>'] +
+      [u''.join([u'<custom_field>', tag('custom_field_name', 'Field_%d' % c),
+                 tag('custom_field_value', rnd.randint(0, 1000)), u'</custom_field>'])
+       for c in xrange(custom_fields)] +
+      [u'</custom_fields><transaction_details>'] + products +
+      [u'</transaction_details></transaction>'])
+  out.append(u'</transactions></foxydata>')
+  return u''.join(out).encode('utf-8')
+
+
+def encrypt_feed(markup, key):
+  """
+  `markup` as the view receives it: RC4 encrypted and url encoded.
+  """
+  return urllib.quote_plus(FastARC4(key).crypt(markup))
+
+
+def legacy_parse(markup):
+  """
+  The original minidom/getElementsByTagName extraction, kept as a baseline.
+  """
+  def extract_kv_node(node, key_name):
+    el = node.getElementsByTagName(key_name)
+    return len(el) > 0 and el[0].firstChild.data or ''
+
+  transactions = []
+  for node in parseString(markup).getElementsByTagName('transaction'):
+    tx = {'id': extract_kv_node(node, 'id'),
+          'date': datetime.strptime(extract_kv_node(node, 'transaction_date'),
+                                    FoxyData.DateTimeFmt),
+          'customer_id': extract_kv_node(node, 'customer_id'),
+          'custom_fields': {}, 'items': []}
+    for custom_field in node.getElementsByTagName('custom_field'):
+      tx['custom_fields'][extract_kv_node(custom_field, 'custom_field_name')] = \
+       extract_kv_node(custom_field, 'custom_field_value')
+    for details in node.getElementsByTagName('transaction_detail'):
+      item = {'product_code': extract_kv_node(details, 'product_code')}
+      for key in ['subscription_startdate', 'next_transaction_date']:
+        date_str = extract_kv_node(details, key)
+        try:
+          item[key] = datetime.strptime(date_str, FoxyData.DateFmt)
+        except ValueError:
+          item[key] = date_str
+      detail = item['detail'] = {}
+      for detail_opt in details.getElementsByTagName('transaction_detail_option'):
+        detail[extract_kv_node(detail_opt, 'product_option_name')] = \
+         extract_kv_node(detail_opt, 'product_option_value')
+      tx['items'].append(item)
+    transactions.append(tx)
+  return transactions
+
+
+def best_of(repeat, func, *args):
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    func(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def report(name, seconds, size):
+  sys.stdout.write("  %-24s %9.4fs %9.2f MB/s\n" %
+                   (name, seconds, size / seconds / (1024 * 1024)))
+
+
+def bench_rc4(options):
+  data = load_fixture(options.size)
+  crypted = ARC4(SECRET_KEY).crypt(data)
+  assert FastARC4(SECRET_KEY).crypt(crypted) == data
+  assert FastARC4(SECRET_KEY, use_numpy=False).crypt(crypted) == data
+
+  sys.stdout.write("RC4 decrypt of %d bytes (best of %d)\n" %
+                   (len(data), options.repeat))
+  engines = [('ARC4', lambda: ARC4(SECRET_KEY)),
+             ('FastARC4 (long xor)', lambda: FastARC4(SECRET_KEY, use_numpy=False))]
+  if numpy is not None:
+    engines.append(('FastARC4 (numpy xor)', lambda: FastARC4(SECRET_KEY, use_numpy=True)))
+  for name, factory in engines:
+    report(name, best_of(options.repeat, lambda: factory().crypt(crypted)), len(data))
+
+
+def bench_ksa(options):
+  keys = [SECRET_KEY + str(i) for i in xrange(options.keys)]
+  crypted = FastARC4(SECRET_KEY).crypt(load_fixture(options.size))
+
+  def per_request(func):
+    def run():
+      for i in xrange(options.calls):
+        func(keys[i % len(keys)])
+    return best_of(options.repeat, run) / options.calls * 1e6
+
+  sys.stdout.write("Per request cipher setup, and setup plus decrypt of %d bytes,"
+                   " %d keys (best of %d)\n" % (len(crypted), len(keys), options.repeat))
+  for name, factory in [('FastARC4(key)', FastARC4), ('FastARC4.for_key(key)', FastARC4.for_key)]:
+    setup = per_request(factory)
+    total = per_request(lambda key: factory(key).crypt(crypted))
+    sys.stdout.write("  %-24s %9.1fus %9.1fus\n" % (name, setup, total))
+
+
+def bench_parse(options):
+  counts = [int(c) for c in options.counts.split(',')]
+  sys.stdout.write("Parsing synthetic feeds (best of %d)\n" % options.repeat)
+  sys.stdout.write("  %12s %12s %12s %12s\n" %
+                   ('transactions', 'FoxyData', 'legacy', 'us/tx'))
+  for count in counts:
+    markup = make_feed(count)
+    current = best_of(options.repeat, FoxyData, markup)
+    if count <= options.legacy_max:
+      legacy = "%11.3fs" % best_of(options.repeat, legacy_parse, markup)
+    else:
+      legacy = "%12s" % 'skipped'
+    sys.stdout.write("  %12d %11.3fs %s %12.1f\n" %
+                     (count, current, legacy, current / count * 1e6))
+
+
+def bench_api(options):
+  from foxyapi import FoxyClient
+  from foxystub import StubFoxyServer
+  server = StubFoxyServer(connect_delay=options.connect_delay).start()
+  data = {'name': 'status', 'value': 'shipped', 'type': 'transaction'}
+
+  def one_connection_per_call():
+    for i in xrange(options.calls):
+      params = dict(data, identifier=i, api_token=SECRET_KEY, api_action='attribute_save')
+      urllib2.urlopen(server.url, urllib.urlencode(params)).read()
+
+  def pooled():
+    client = FoxyClient(server.url, SECRET_KEY)
+    for i in xrange(options.calls):
+      client.call('attribute_save', dict(data, identifier=i))
+
+  sys.stdout.write("%d API calls against a local stub server, %.1fms per connect"
+                   " (best of %d)\n" % (options.calls, options.connect_delay * 1000,
+                                        options.repeat))
+  for name, func in [('urllib2.urlopen', one_connection_per_call),
+                     ('FoxyClient', pooled)]:
+    seconds = best_of(options.repeat, func)
+    sys.stdout.write("  %-24s %9.4fs %9.1f calls/s\n" % (name, seconds, options.calls / seconds))
+  server.stop()
+
+
+def feed_options(options):
+  return dict(transactions=options.transactions, details=options.details,
+              options=options.options, custom_fields=options.custom_fields,
+              seed=options.seed)
+
+
+def max_rss():
+  """
+  Peak resident set size of this process in KB.
+  """
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return sys.platform == 'darwin' and rss // 1024 or rss
+
+
+def run_pipeline(payload, key):
+  """
+  Run the stages of views.process_feed one after the other on `payload`,
+  returning (stage, seconds, peak RSS growth in KB, output) tuples.
+  """
+  def unquote(payload):
+    return urllib.unquote_plus(payload)
+  def decrypt(crypted):
+    return FastARC4.for_key(key).crypt(crypted)
+  def parse(markup):
+    parser = FeedParser()
+    parser.feed(markup, True)
+    return parser.drain()
+  def build(transactions):
+    # Touch the lazily converted fields, as a handler would
+    for transaction in transactions:
+      transaction.date
+      for item in transaction.items:
+        item.subscription_startdate, item.next_transaction_date, item.detail
+    return transactions
+  def dispatch(transactions):
+    import foxyhandlers
+    return foxyhandlers.dispatch(transactions, handlers=[(len, None)], batch_size=500)
+
+  results = []
+  value = payload
+  for name, stage in [('unquote', unquote), ('decrypt', decrypt), ('parse', parse),
+                      ('model build', build), ('dispatch', dispatch)]:
+    rss = max_rss()
+    start = time.time()
+    value = stage(value)
+    results.append((name, time.time() - start, max_rss() - rss, value))
+  return results
+
+
+def bench_pipeline(options):
+  if not options.payload:
+    # Generating the feed takes far more memory than handling it; do that
+    # here and measure in a fresh process.
+    fd, path = tempfile.mkstemp(suffix='.foxydata')
+    os.close(fd)
+    try:
+      options.output, output = path, options.output
+      generate(options)
+      argv = options.argv + ['--payload', path]
+      if output:
+        argv += ['--output', output]
+      subprocess.check_call([sys.executable, os.path.abspath(__file__)] + argv)
+    finally:
+      os.unlink(path)
+    return
+
+  with open(options.payload, 'rb') as f:
+    payload = f.read()
+  stages = []
+  for i in range(options.repeat):
+    run = run_pipeline(payload, SECRET_KEY)
+    markup, count = run[1][3], run[-1][3]
+    if i == 0:
+      stages = [{'stage': name, 'seconds': seconds, 'peak_rss_growth_kb': rss}
+                for name, seconds, rss, value in run]
+    else:
+      for stage, (name, seconds, rss, value) in zip(stages, run):
+        stage['seconds'] = min(stage['seconds'], seconds)
+    del run
+  result = {
+    'benchmark': 'pipeline',
+    'date': datetime.utcnow().strftime(FoxyData.DateTimeFmt),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'numpy': numpy is not None,
+    'feed': dict(feed_options(options), transactions=count,
+                 markup_bytes=len(markup), payload_bytes=len(payload)),
+    'repeat': options.repeat,
+    'stages': stages,
+    'total_seconds': sum(stage['seconds'] for stage in stages),
+    'peak_rss_kb': max_rss(),
+  }
+
+  sys.stdout.write("Datafeed pipeline: %d transactions, %d bytes of markup (best of %d)\n" %
+                   (count, len(markup), options.repeat))
+  for stage in stages:
+    sys.stdout.write("  %-12s %9.4fs %9.2f MB/s %+9d KB peak RSS\n" %
+                     (stage['stage'], stage['seconds'],
+                      len(markup) / max(stage['seconds'], 1e-9) / (1024 * 1024),
+                      stage['peak_rss_growth_kb']))
+  sys.stdout.write("  %-12s %9.4fs\n" % ('total', result['total_seconds']))
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(result, f, indent=2, sort_keys=True)
+    sys.stdout.write("Results written to %s\n" % options.output)
+
+
+def bench_projection(options):
+  markup = generate_feed(**feed_options(options))
+  sys.stdout.write("Parsing %d transactions (%d bytes) with projections (best of %d)\n" %
+                   (options.transactions, len(markup), options.repeat))
+  for fields in [None] + [f.split(',') for f in options.fields.split(';')]:
+    seconds = best_of(options.repeat, FoxyData, markup, 1, PARALLEL_MIN_SIZE, fields)
+    sys.stdout.write("  %-36s %9.3fs\n" % (fields and ','.join(fields) or 'all fields', seconds))
+
+
+def bench_export(options):
+  transactions = FoxyData(generate_feed(**feed_options(options))).transactions
+
+  def row_loops():
+    revenue, counts = {}, {}
+    for transaction in transactions:
+      day = transaction.date.strftime(FoxyData.DateFmt)
+      counts[day] = counts.get(day, 0) + 1
+      for item in transaction.items:
+        revenue[item.product_code] = (revenue.get(item.product_code, 0) +
+                                      float(item.product_price) * int(item.product_quantity))
+    return revenue, counts
+
+  export = export_transactions(transactions)
+  def aggregate():
+    return revenue_by_product(export), counts_by_date(export)
+
+  sys.stdout.write("Revenue by product and counts by date over %d transactions"
+                   " (best of %d, %s)\n" % (len(transactions), options.repeat,
+                                           numpy is None and 'no NumPy' or 'NumPy'))
+  for name, func in [('row loops', row_loops),
+                     ('export_transactions', lambda: export_transactions(transactions)),
+                     ('columnar aggregations', aggregate)]:
+    sys.stdout.write("  %-24s %9.4fs\n" % (name, best_of(options.repeat, func)))
+
+
+def bench_parallel(options):
+  markup = generate_feed(**feed_options(options))
+  sys.stdout.write("Parsing %d transactions (%d bytes) on N processes, %d cores"
+                   " (best of %d)\n" % (options.transactions, len(markup),
+                                        multiprocessing.cpu_count(), options.repeat))
+  sys.stdout.write("  %9s %12s %9s\n" % ('processes', 'seconds', 'speedup'))
+  serial = None
+  for processes in [int(p) for p in options.processes.split(',')]:
+    if processes > 1:
+      parse_parallel('<foxydata/>', processes) # start the pool outside the timing
+    seconds = best_of(options.repeat, FoxyData, markup, processes, 0)
+    serial = serial or seconds
+    sys.stdout.write("  %9d %11.3fs %8.2fx\n" % (processes, seconds, serial / seconds))
+
+
+def generate(options):
+  if not options.output:
+    raise SystemExit("generate needs --output")
+  with open(options.output, 'wb') as f:
+    f.write(encrypt_feed(generate_feed(**feed_options(options)), SECRET_KEY))
+
+
+BENCHMARKS = {
+  'rc4': bench_rc4,
+  'parse': bench_parse,
+  'api': bench_api,
+  'ksa': bench_ksa,
+  'pipeline': bench_pipeline,
+  'parallel': bench_parallel,
+  'export': bench_export,
+  'projection': bench_projection,
+  'generate': generate,
+}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="foxycart datafeed benchmarks")
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--size', type=int, default=1024 * 1024,
+                      help="payload size in bytes")
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--counts', default='1000,10000,100000',
+                      help="comma separated transaction counts for parse")
+  parser.add_argument('--legacy-max', type=int, default=10000,
+                      help="largest feed to run the legacy parser on")
+  parser.add_argument('--calls', type=int, default=1000,
+                      help="number of API calls for api, requests for ksa")
+  parser.add_argument('--keys', type=int, default=1,
+                      help="number of datafeed keys for ksa")
+  parser.add_argument('--connect-delay', type=float, default=0.005,
+                      help="simulated handshake cost per connection for api")
+  parser.add_argument('--transactions', type=int, default=10000,
+                      help="transactions in a generated feed")
+  parser.add_argument('--details', type=int, default=2,
+                      help="products per generated transaction")
+  parser.add_argument('--options', type=int, default=2,
+                      help="options per generated product")
+  parser.add_argument('--custom-fields', type=int, default=2,
+                      help="custom fields per generated transaction")
+  parser.add_argument('--seed', type=int, default=0,
+                      help="random seed for the generated feed")
+  parser.add_argument('--output',
+                      help="file for the pipeline results (JSON) or generated payload")
+  parser.add_argument('--processes', default='1,2,4',
+                      help="comma separated process counts for parallel")
+  parser.add_argument('--fields', default='id,customer_id;id,custom_fields;items',
+                      help="semicolon separated projections for projection")
+  parser.add_argument('--payload',
+                      help="payload written by generate to run pipeline on")
+  if argv is None:
+    argv = sys.argv[1:]
+  options = parser.parse_args(argv)
+  options.argv = argv
+  BENCHMARKS[options.benchmark](options)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,630 @@
+"""
+Client for the FoxyCart API, shared by the foxy_command management command
+and application code.
+
+Connections are HTTP/1.1 keep-alive and pooled per host, so bulk jobs pay
+for the TCP and TLS handshakes once instead of once per API action.
+"""
+
+import re
+import time
+import Queue
+import socket
+import urllib
+import hashlib
+import httplib
+import logging
+import urlparse
+import tempfile
+import threading
+from collections import OrderedDict
+from xml.dom.minidom import parseString
+from xml.parsers.expat import ExpatError
+
+from django.conf import settings
+
+from foxyutils import FeedParser
+
+log = logging.getLogger(__name__)
+
+
+class FoxyApiError(Exception):
+  pass
+
+
+_RESULT = re.compile(r'<result>\s*(\w+)\s*</result>')
+
+def response_status(body, limit = 1024):
+  """
+  The <result> of an API response ('SUCCESS' or 'ERROR'), found by scanning
+  only the first `limit` bytes of `body`; None if it isn't there.
+  """
+  match = _RESULT.search(body, 0, limit)
+  return match and match.group(1)
+
+
+class FoxyResponse(object):
+  """
+  A response to an API action.  `status` and `ok` only look at the start of
+  the body; `messages`, `statistics` and `records` (Transaction, Customer
+  and Subscription objects) parse it on first use, and `doc` gives the
+  minidom document for responses those don't cover.
+
+  Responses with an HTTP error status, and bodies without a <result> (an
+  error page from a proxy, say), get the status 'ERROR'; when the body has
+  no messages the HTTP status and the start of the body make up one.
+  """
+  def __init__(self, action, body, http_status = None):
+    self.action = action
+    self.body = body
+    self.http_status = http_status
+    self._parser = self._records = self._doc = None
+    self.status = response_status(body)
+    if self.status is None:
+      self.status = self.parser.result or 'ERROR'
+    if http_status is not None and http_status >= 400:
+      self.status = 'ERROR'
+
+  def __str__(self):
+    return self.body
+
+  @property
+  def ok(self):
+    return self.status != 'ERROR'
+
+  @property
+  def parser(self):
+    if self._parser is None:
+      parser = FeedParser()
+      try:
+        parser.feed(self.body, True)
+        self._records = parser.drain()
+      except ExpatError:
+        parser = FeedParser()
+        self._records = []
+      if not parser.messages and (parser.result is None or self.http_status >= 400):
+        parser.messages.append("Unexpected response to %s (HTTP %s): %s" % (
+          self.action, self.http_status or 'status unknown', self.body[:200].strip()))
+      self._parser = parser
+    return self._parser
+
+  @property
+  def messages(self):
+    return self.parser.messages
+
+  @property
+  def statistics(self):
+    return self.parser.statistics
+
+  @property
+  def records(self):
+    self.parser
+    return self._records
+
+  @property
+  def doc(self):
+    if self._doc is None:
+      self._doc = parseString(self.body)
+    return self._doc
+
+  def raise_for_status(self):
+    if not self.ok:
+      raise FoxyApiError('; '.join(self.messages) or "%s failed" % self.action)
+    return self
+
+
+# Actions that only read, so sending them twice does no harm
+IDEMPOTENT_SUFFIXES = ('_get', '_list')
+
+
+class ConnectionPool(object):
+  """
+  Keeps up to `size` idle keep-alive connections to one host.  Connections
+  idle for longer than `idle_timeout` seconds are closed instead of reused.
+  """
+  def __init__(self, scheme, netloc, size = 4, idle_timeout = 30, timeout = 30):
+    if scheme == 'https':
+      self.connection_class = httplib.HTTPSConnection
+    else:
+      self.connection_class = httplib.HTTPConnection
+    self.netloc = netloc
+    self.size = size
+    self.idle_timeout = idle_timeout
+    self.timeout = timeout
+    self.idle = []
+    self.lock = threading.Lock()
+
+  def get(self):
+    now = time.time()
+    with self.lock:
+      while self.idle:
+        connection, last_used = self.idle.pop()
+        if now - last_used <= self.idle_timeout:
+          return connection
+        connection.close()
+    return self.connection_class(self.netloc, timeout=self.timeout)
+
+  def put(self, connection):
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append((connection, time.time()))
+        return
+    connection.close()
+
+  def close(self):
+    with self.lock:
+      for connection, last_used in self.idle:
+        connection.close()
+      del self.idle[:]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(scheme, netloc, **options):
+  """
+  The shared pool for a host; `options` only apply when it is created.
+  """
+  with _pools_lock:
+    key = (scheme, netloc)
+    if key not in _pools:
+      _pools[key] = ConnectionPool(scheme, netloc, **options)
+    return _pools[key]
+
+
+# Read-only actions whose responses may be cached, with the number of
+# seconds a response stays fresh.  FoxyCart asks for store_includes_get in
+# particular to be cached.
+CACHE_TTLS = {
+  'store_includes_get': 3600,
+  'category_list': 600,
+  'downloadable_list': 600,
+}
+
+
+class LRUCache(object):
+  """
+  In-process cache tier holding at most `max_entries` entries.
+  """
+  def __init__(self, max_entries = 256):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      value = self.entries.pop(key, None)
+      if value is not None:
+        self.entries[key] = value
+      return value
+
+  def set(self, key, value, timeout):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+
+class _Flight(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = self.error = None
+
+
+class ResponseCache(object):
+  """
+  Caches the (HTTP status, body) responses of read-only actions, keyed by
+  action and arguments.  Only 2xx responses whose <result> is SUCCESS are
+  cached, since an error may be gone by the next request.  A response is
+  fresh for its action's ttl; for `stale_ttl` seconds after that it is
+  still served while a single background request refreshes it.  Concurrent
+  misses for the same key share one request.
+
+  Lookups go to the in-process LRU tier first and then to `backend`, an
+  optional Django cache (anything with get(key) and set(key, value, timeout)).
+  """
+  def __init__(self, ttls = None, stale_ttl = 60, max_entries = 256, backend = None):
+    self.ttls = dict(CACHE_TTLS, **(ttls or {}))
+    self.stale_ttl = stale_ttl
+    self.local = LRUCache(max_entries)
+    self.backend = backend
+    self.flights = {}
+    self.lock = threading.Lock()
+
+  def key(self, action, data):
+    arguments = urllib.urlencode(sorted((data or {}).items()))
+    return 'foxyapi:%s:%s' % (action, hashlib.md5(arguments).hexdigest())
+
+  def lookup(self, key):
+    entry = self.local.get(key)
+    if entry is None and self.backend is not None:
+      entry = self.backend.get(key)
+      if entry is not None:
+        self.local.set(key, entry, None)
+    return entry
+
+  def store(self, key, ttl, response):
+    entry = (response, time.time())
+    self.local.set(key, entry, ttl + self.stale_ttl)
+    if self.backend is not None:
+      self.backend.set(key, entry, ttl + self.stale_ttl)
+
+  def get(self, action, data, fetch):
+    """
+    The cached response for `action`, calling fetch() to get it when needed.
+    """
+    ttl = self.ttls[action]
+    key = self.key(action, data)
+    entry = self.lookup(key)
+    if entry is not None:
+      response, fetched = entry
+      age = time.time() - fetched
+      if age < ttl:
+        return response
+      if age < ttl + self.stale_ttl:
+        thread = threading.Thread(target=self.fetch, args=(key, ttl, fetch, True),
+                                  name='foxyapi-refresh')
+        thread.daemon = True
+        thread.start()
+        return response
+    return self.fetch(key, ttl, fetch)
+
+  def fetch(self, key, ttl, fetch, background = False):
+    with self.lock:
+      flight = self.flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self.flights[key] = _Flight()
+    if not leader:
+      if background:
+        return None
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.value
+
+    try:
+      flight.value = fetch()
+      http_status, body = flight.value
+      if 200 <= http_status < 300 and response_status(body) == 'SUCCESS':
+        self.store(key, ttl, flight.value)
+    except Exception, e:
+      flight.error = e
+      if background:
+        log.warning("Refreshing cached %s failed: %r", key, e)
+    finally:
+      with self.lock:
+        del self.flights[key]
+      flight.done.set()
+    if flight.error is not None and not background:
+      raise flight.error
+    return flight.value
+
+
+class Response(object):
+  """
+  A streamed API response.  Read it, then close() it so the connection can
+  go back to the pool.
+  """
+  def __init__(self, pool, connection, response):
+    self.pool = pool
+    self.connection = connection
+    self.response = response
+    self.status = response.status
+
+  def read(self, size = None):
+    if size is None:
+      return self.response.read()
+    return self.response.read(size)
+
+  def close(self):
+    if self.connection is None:
+      return
+    if self.response.isclosed() and not self.response.will_close:
+      self.pool.put(self.connection)
+    else:
+      self.connection.close()
+    self.connection = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+class FoxyClient(object):
+  """
+  Sends API actions to `api_url` (the store's .../api URL).  Requests that
+  never reached FoxyCart (failed connects, kept-alive connections the server
+  had already closed) are retried up to `retries` times, sleeping `backoff`,
+  2 * `backoff`, ... seconds in between.  Other failures (5xx responses,
+  timeouts, dropped connections) are only retried for idempotent actions,
+  which by default are the read-only *_get and *_list ones; pass
+  idempotent=True or False to decide per call.  With a ResponseCache, call()
+  answers the actions it has a ttl for from the cache.
+  """
+  def __init__(self, api_url, api_token, pool_size = 4, idle_timeout = 30,
+               retries = 3, backoff = 0.5, timeout = 30, cache = None):
+    url = urlparse.urlsplit(api_url)
+    self.path = url.path or '/'
+    self.api_token = api_token
+    self.retries = retries
+    self.backoff = backoff
+    self.cache = cache
+    self.pool = get_pool(url.scheme, url.netloc, size=pool_size,
+                         idle_timeout=idle_timeout, timeout=timeout)
+
+  def encode(self, action, data):
+    params = dict(data or {})
+    params['api_token'] = self.api_token
+    params['api_action'] = action
+    return urllib.urlencode(params)
+
+  def open(self, action, data = None, idempotent = None):
+    """
+    Send `action` with the arguments in `data` and return the Response.
+    """
+    if idempotent is None:
+      idempotent = action.endswith(IDEMPOTENT_SUFFIXES)
+    body = self.encode(action, data)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    attempt = 0
+    while True:
+      connection = self.pool.get()
+      reused = connection.sock is not None
+      connected = False
+      try:
+        if not reused:
+          connection.connect()
+        connected = True
+        connection.request('POST', self.path, body, headers)
+        response = connection.getresponse()
+        if response.status < 500:
+          return Response(self.pool, connection, response)
+        response.read()
+        error = FoxyApiError("HTTP %d from FoxyCart API" % response.status)
+      except (socket.error, httplib.HTTPException), e:
+        error = e
+      connection.close()
+      # An idle connection closed by the server answers with an empty status line
+      unsent = not connected or reused and isinstance(error, httplib.BadStatusLine)
+      if attempt >= self.retries or not (unsent or idempotent):
+        raise error
+      log.debug("Retrying %s after %r", action, error)
+      time.sleep(self.backoff * 2 ** attempt)
+      attempt += 1
+
+  def call(self, action, data = None, idempotent = None):
+    """
+    Send `action` and return the response body.
+    """
+    return self.call_with_status(action, data, idempotent)[1]
+
+  def call_with_status(self, action, data = None, idempotent = None):
+    """
+    Send `action` and return (HTTP status, response body).
+    """
+    if self.cache is not None and action in self.cache.ttls:
+      return self.cache.get(action, data,
+                            lambda: self.call_uncached(action, data, idempotent))
+    return self.call_uncached(action, data, idempotent)
+
+  def call_uncached(self, action, data = None, idempotent = None):
+    response = self.open(action, data, idempotent)
+    try:
+      return response.status, response.read()
+    finally:
+      response.close()
+
+  def request(self, action, data = None, idempotent = None):
+    """
+    Send `action` and return the response as a FoxyResponse.
+    """
+    http_status, body = self.call_with_status(action, data, idempotent)
+    return FoxyResponse(action, body, http_status)
+
+
+class _PrefetchedPage(object):
+  """
+  Downloads a page in the background into a spooled temporary file; read()
+  waits for the download to finish.
+  """
+  def __init__(self, client, action, data, bufsize):
+    self.file = tempfile.SpooledTemporaryFile(max_size=16 * bufsize)
+    self.error = None
+    self.thread = threading.Thread(target=self.fetch, args=(client, action, data, bufsize),
+                                   name='foxyapi-prefetch')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def fetch(self, client, action, data, bufsize):
+    try:
+      with client.open(action, data) as response:
+        while True:
+          chunk = response.read(bufsize)
+          if not chunk:
+            break
+          self.file.write(chunk)
+      self.file.seek(0)
+    except Exception, e:
+      self.error = e
+
+  def read(self, size):
+    if self.thread.is_alive():
+      self.thread.join()
+    if self.error is not None:
+      raise self.error
+    return self.file.read(size)
+
+  def close(self):
+    self.thread.join()
+    self.file.close()
+
+
+def _next_page_start(parser):
+  """
+  The pagination_start of the page after the one being parsed: None while
+  the statistics have not been read yet, 0 if this is the last page.
+  """
+  statistics = parser.statistics
+  if 'pagination_end' not in statistics or 'filtered_total' not in statistics:
+    return None
+  end = int(statistics['pagination_end'] or 0)
+  if not end or end >= int(statistics['filtered_total'] or 0):
+    return 0
+  return end + 1
+
+
+def iter_list(client, action, filters = None, prefetch = False, bufsize = 64 * 1024,
+              start = 1):
+  """
+  Yield the records of a list action (transaction_list, customer_list,
+  subscription_list) as Transaction, Customer or Subscription objects,
+  following the pagination through every page, beginning with record
+  number `start`.  Pages are parsed as they arrive from the socket, so
+  memory use does not depend on the number of records.  With `prefetch`
+  the next page is downloaded while the current one is still being
+  consumed.
+  """
+  filters = dict(filters or {})
+  page = client.open(action, dict(filters, pagination_start=start))
+  next_page = None
+  try:
+    while page is not None:
+      parser = FeedParser()
+      try:
+        while True:
+          chunk = page.read(bufsize)
+          if not chunk:
+            break
+          parser.feed(chunk)
+          if prefetch and next_page is None:
+            start = _next_page_start(parser)
+            if start:
+              next_page = _PrefetchedPage(client, action,
+                                          dict(filters, pagination_start=start), bufsize)
+          for record in parser.drain():
+            yield record
+        parser.feed('', True)
+      finally:
+        page.close()
+      if parser.result == 'ERROR':
+        raise FoxyApiError('; '.join(parser.messages) or "%s failed" % action)
+      for record in parser.drain():
+        yield record
+
+      if next_page is None:
+        start = _next_page_start(parser)
+        if start:
+          next_page = client.open(action, dict(filters, pagination_start=start))
+      page, next_page = next_page, None
+  finally:
+    if next_page is not None:
+      next_page.close()
+
+
+class RateLimiter(object):
+  """
+  Spaces calls to wait() at least 1/rate seconds apart, across threads.  A
+  rate of 0 or None means no limit.
+  """
+  def __init__(self, rate):
+    self.interval = rate and 1.0 / rate or 0
+    self.next_slot = 0
+    self.lock = threading.Lock()
+
+  def wait(self):
+    if not self.interval:
+      return
+    with self.lock:
+      now = time.time()
+      slot = max(now, self.next_slot)
+      self.next_slot = slot + self.interval
+    if slot > now:
+      time.sleep(slot - now)
+
+
+def run_batch(func, items, workers = 4, max_pending = None):
+  """
+  Call func(item) for every item on `workers` threads and yield
+  (item, result, error) triples in input order as soon as they are ready.
+  At most `max_pending` items (4 * workers by default) are read ahead of
+  the last one yielded, so `items` may be an endless stream.
+  """
+  max_pending = max_pending or 4 * workers
+  slots = threading.Semaphore(max_pending)
+  tasks = Queue.Queue()
+  results = Queue.Queue()
+  total = []
+  feed_error = []
+
+  def feed():
+    count = 0
+    try:
+      for item in items:
+        slots.acquire()
+        tasks.put((count, item))
+        count += 1
+    except Exception, e:
+      feed_error.append(e)
+    total.append(count)
+    for i in range(workers):
+      tasks.put(None)
+    results.put(None)
+
+  def work():
+    while True:
+      task = tasks.get()
+      if task is None:
+        return
+      index, item = task
+      try:
+        results.put((index, item, func(item), None))
+      except Exception, e:
+        results.put((index, item, None, e))
+
+  threads = [threading.Thread(target=feed, name='foxyapi-batch-feed')]
+  threads += [threading.Thread(target=work, name='foxyapi-batch-%d' % i)
+              for i in range(workers)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  done = {}
+  next_index = 0
+  while not total or next_index < total[0]:
+    result = results.get()
+    if result is not None:
+      done[result[0]] = result[1:]
+    while next_index in done:
+      yield done.pop(next_index)
+      next_index += 1
+      slots.release()
+  if feed_error:
+    raise feed_error[0]
+
+
+_client = None
+
+def get_client():
+  """
+  A FoxyClient for the store configured in the settings.
+  """
+  global _client
+  if _client is None:
+    backend = getattr(settings, 'FOXYCART_API_CACHE_BACKEND', None)
+    if backend is not None:
+      from django.core.cache import get_cache
+      backend = get_cache(backend)
+    cache = ResponseCache(ttls=getattr(settings, 'FOXYCART_API_CACHE_TTLS', None),
+                          stale_ttl=getattr(settings, 'FOXYCART_API_CACHE_STALE', 60),
+                          backend=backend)
+    _client = FoxyClient(settings.FOXYCART_API_URL + '/api',
+                         settings.FOXYCART_DATAFEED_KEY,
+                         pool_size=getattr(settings, 'FOXYCART_API_POOL_SIZE', 4),
+                         idle_timeout=getattr(settings, 'FOXYCART_API_IDLE_TIMEOUT', 30),
+                         retries=getattr(settings, 'FOXYCART_API_RETRIES', 3),
+                         cache=cache)
+  return _client
@@ -0,0 +1,148 @@
+"""
+Append-only log of captured datafeeds, for building test data and for
+replaying production traffic with "python manage.py foxy_replay".
+
+Every captured feed is written as one record, the capture time and the
+RC4 ciphertext, to the current segment of the log: a gzip file in the
+capture directory, named after the time it was started and the process
+writing it.  A segment is closed and a new one started once it holds
+`segment_size` bytes of feeds.  Records are flushed as they are written,
+so a process that dies loses at most the record it was writing.
+"""
+
+import os
+import time
+import glob
+import zlib
+import gzip
+import struct
+import threading
+
+from django.conf import settings
+
+_HEADER = struct.Struct('>dI')  # capture time, payload length
+
+
+class CaptureLog(object):
+  def __init__(self, directory, segment_size = 64 * 1024 * 1024):
+    self.directory = directory
+    self.segment_size = segment_size
+    self.lock = threading.Lock()
+    self.segment = None
+    self.sequence = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _close_segment(self):
+    if self.segment is not None:
+      self.segment.close()
+      self.segment = None
+
+  def _open_segment(self):
+    self._close_segment()
+    self.sequence += 1
+    name = 'capture-%s-%d-%04d.gz' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                                      self.sequence)
+    self.segment = gzip.open(os.path.join(self.directory, name), 'ab')
+    self.segment_bytes = 0
+
+  def append(self, crypted, timestamp = None):
+    """
+    Add a feed's ciphertext (str, bytearray or memoryview) to the log.
+    """
+    crypted = bytes(crypted)
+    with self.lock:
+      if self.segment is None or self.segment_bytes >= self.segment_size:
+        self._open_segment()
+      self.segment.write(_HEADER.pack(timestamp or time.time(), len(crypted)))
+      self.segment.write(crypted)
+      self.segment.flush(zlib.Z_SYNC_FLUSH)
+      self.segment_bytes += _HEADER.size + len(crypted)
+
+  def close(self):
+    with self.lock:
+      self._close_segment()
+
+
+def segment_paths(paths):
+  """
+  The segment files in `paths` (segments or capture directories), oldest
+  first.
+  """
+  segments = []
+  for path in paths:
+    if os.path.isdir(path):
+      segments.extend(glob.glob(os.path.join(path, 'capture-*.gz')))
+    else:
+      segments.append(path)
+  return sorted(segments, key=os.path.basename)
+
+
+def _decompressed_chunks(path, bufsize = 64 * 1024):
+  # zlib rather than gzip.GzipFile, which never returns on a segment
+  # that is still being written (or was cut short) and has no trailer.
+  f = open(path, 'rb')
+  try:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+      data = f.read(bufsize)
+      if not data:
+        return
+      while data:
+        yield decompressor.decompress(data)
+        data = decompressor.unused_data
+        if data:
+          # Next gzip member
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  finally:
+    f.close()
+
+
+def read_segment(path):
+  """
+  Yield the (timestamp, ciphertext) records of one segment.  A record cut
+  short by a crash ends the segment.
+  """
+  buf = ''
+  need = _HEADER.size
+  header = None
+  try:
+    for chunk in _decompressed_chunks(path):
+      buf += chunk
+      while len(buf) >= need:
+        if header is None:
+          header = _HEADER.unpack(buf[:need])
+          buf = buf[need:]
+          need = header[1]
+        else:
+          yield header[0], buf[:need]
+          buf = buf[need:]
+          header, need = None, _HEADER.size
+  except zlib.error:
+    return
+
+
+def read_captures(paths):
+  """
+  Yield the (timestamp, ciphertext) records of every segment in `paths`.
+  """
+  for path in segment_paths(paths):
+    for record in read_segment(path):
+      yield record
+
+
+_capture_log = None
+_capture_log_lock = threading.Lock()
+
+def get_capture_log():
+  """
+  The log in FOXYCART_CAPTURE_DIR (default: captures in this app).
+  """
+  global _capture_log
+  with _capture_log_lock:
+    if _capture_log is None:
+      _capture_log = CaptureLog(
+        getattr(settings, 'FOXYCART_CAPTURE_DIR',
+                os.path.join(os.path.dirname(__file__), 'captures')),
+        getattr(settings, 'FOXYCART_CAPTURE_SEGMENT_SIZE', 64 * 1024 * 1024))
+    return _capture_log
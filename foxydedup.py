@@ -0,0 +1,185 @@
+"""
+Duplicate transaction detection for the datafeed.
+
+Ids are claimed by storing them in the SeenTransaction model before their
+transactions are dispatched; the unique transaction_id column decides which
+of several workers gets an id, so only one of them handles it.  A bloom
+filter of the ids stored when the process started, and of those it has
+claimed since, sits in front of the insert: only the (few) ids it reports as
+possibly seen are looked up, with one bulk IN query per feed.
+"""
+
+import math
+import struct
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from models import SeenTransaction, atomic
+
+
+class DuplicateFeedError(ValueError):
+  """
+  Raised when every transaction in a datafeed has been handled before.
+  """
+  pass
+
+
+class BloomFilter(object):
+  """
+  Bloom filter sized for `capacity` keys at a false positive rate of
+  `error_rate`.  Positions come from double hashing a single md5 digest.
+  """
+  def __init__(self, capacity, error_rate):
+    self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+    self.bits = bytearray((self.size + 7) // 8)
+
+  def positions(self, key):
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+  def add(self, key):
+    bits = self.bits
+    for position in self.positions(key):
+      bits[position >> 3] |= 1 << (position & 7)
+
+  def __contains__(self, key):
+    bits = self.bits
+    for position in self.positions(key):
+      if not bits[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+
+
+class TransactionDeduplicator(object):
+  """
+  Splits transactions into new ones and ones already recorded as seen.
+  `stats` counts ids the bloom filter ruled out without a query (misses),
+  ids it passed on to the database (hits), the false positives among those
+  and the duplicate transactions found.
+  """
+  # Stay below sqlite's limit on query parameters
+  query_batch_size = 500
+
+  def __init__(self, capacity = 1000000, error_rate = 0.001):
+    self.bloom = BloomFilter(capacity, error_rate)
+    self.lock = threading.Lock()
+    self.warm = False
+    self.stats = {'bloom_misses': 0, 'bloom_hits': 0,
+                  'false_positives': 0, 'duplicates': 0}
+
+  def warm_up(self):
+    """
+    Load every stored id into the bloom filter.
+    """
+    with self.lock:
+      if not self.warm:
+        for transaction_id in SeenTransaction.objects.values_list(
+         'transaction_id', flat=True).iterator():
+          self.bloom.add(transaction_id)
+        self.warm = True
+
+  def seen_ids(self, ids):
+    seen = set()
+    for start in xrange(0, len(ids), self.query_batch_size):
+      seen.update(SeenTransaction.objects.filter(
+        transaction_id__in=ids[start:start + self.query_batch_size]
+      ).values_list('transaction_id', flat=True))
+    return seen
+
+  def split(self, transactions):
+    """
+    Return (new, duplicates).  A repeated id within the same feed counts as
+    a duplicate too.
+    """
+    self.warm_up()
+    candidates = set(tx.id for tx in transactions if tx.id in self.bloom)
+    stored = candidates and self.seen_ids(list(candidates)) or set()
+
+    new, duplicates = [], []
+    seen = set(stored)
+    for tx in transactions:
+      if tx.id in seen:
+        duplicates.append(tx)
+      else:
+        new.append(tx)
+        seen.add(tx.id)
+
+    with self.lock:
+      self.stats['bloom_hits'] += len(candidates)
+      self.stats['bloom_misses'] += len(transactions) - len(candidates)
+      self.stats['false_positives'] += len(candidates - stored)
+      self.stats['duplicates'] += len(duplicates)
+    return new, duplicates
+
+  def insert(self, ids):
+    """
+    Store `ids` and return the set of those stored by this call; ids another
+    worker stored first are left out.
+    """
+    try:
+      with atomic():
+        SeenTransaction.objects.bulk_create(
+          [SeenTransaction(transaction_id=transaction_id) for transaction_id in ids])
+      return set(ids)
+    except IntegrityError:
+      pass
+    claimed = set()
+    for transaction_id in ids:
+      try:
+        with atomic():
+          SeenTransaction.objects.create(transaction_id=transaction_id)
+      except IntegrityError:
+        continue
+      claimed.add(transaction_id)
+    return claimed
+
+  def claim(self, transactions):
+    """
+    Like split, but the new transactions' ids are stored before returning,
+    so a transaction is new for one caller only, whichever process it is in.
+    Call release() with the new transactions if they could not be handled.
+    """
+    new, duplicates = self.split(transactions)
+    claimed = new and self.insert([tx.id for tx in new]) or set()
+    taken = [tx for tx in new if tx.id not in claimed]
+    if taken:
+      new = [tx for tx in new if tx.id in claimed]
+      duplicates.extend(taken)
+    with self.lock:
+      self.stats['duplicates'] += len(taken)
+      for transaction_id in claimed:
+        self.bloom.add(transaction_id)
+    return new, duplicates
+
+  def release(self, transactions):
+    """
+    Forget claimed transactions, so a resent feed handles them again.
+    """
+    ids = [tx.id for tx in transactions]
+    for start in xrange(0, len(ids), self.query_batch_size):
+      SeenTransaction.objects.filter(
+        transaction_id__in=ids[start:start + self.query_batch_size]).delete()
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+def get_deduplicator():
+  """
+  The process wide deduplicator, or None unless FOXYCART_DEDUP is set.
+  """
+  global _deduplicator
+  if not getattr(settings, 'FOXYCART_DEDUP', False):
+    return None
+  with _deduplicator_lock:
+    if _deduplicator is None:
+      _deduplicator = TransactionDeduplicator(
+        capacity=getattr(settings, 'FOXYCART_DEDUP_CAPACITY', 1000000),
+        error_rate=getattr(settings, 'FOXYCART_DEDUP_ERROR_RATE', 0.001))
+      _deduplicator.warm_up()
+    return _deduplicator
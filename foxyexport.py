@@ -0,0 +1,248 @@
+"""
+Columnar export of parsed datafeeds for reporting.
+
+export_transactions() flattens transactions, their details, detail options
+and custom fields into four tables of column arrays, in one pass over the
+records:
+
+  transactions    id, customer_id, date, order_total
+  details         transaction, product_code, product_name, price, quantity
+  options         detail, name, value
+  custom_fields   transaction, name, value
+
+`transaction` and `detail` are row numbers in the parent table.  Numbers
+are array('d')/array('l') columns; strings are dictionary encoded, as an
+array('l') of codes into the distinct values, so grouping by one is
+a count over small integers:
+
+  export = export_transactions(FoxyData.from_crypted_str(payload, key).transactions)
+  revenue_by_product(export)          # {'sku00042': 1234.5, ...}
+  counts_by_date(export)              # {'2007-05-04': 3, ...}
+  export.details.write_csv(open('details.csv', 'wb'))
+  export.save_npz('feed.npz')         # needs NumPy
+
+The aggregations use NumPy when it is installed and plain loops over the
+arrays otherwise.
+"""
+
+import csv
+from array import array
+from collections import OrderedDict
+
+from foxyutils import numpy
+
+
+def _float(text):
+  try:
+    return float(text)
+  except (TypeError, ValueError):
+    return 0.0
+
+
+def _int(text):
+  try:
+    return int(text)
+  except (TypeError, ValueError):
+    return int(_float(text))
+
+
+def _day(transaction):
+  # The feed text when the date has not been parsed yet, saving the parse
+  date = transaction._date
+  if isinstance(date, basestring):
+    return date[:10]
+  return date and date.strftime('%Y-%m-%d') or ''
+
+
+class StringColumn(object):
+  """
+  Dictionary encoded strings: `codes` indexes into the distinct `values`.
+  Each extend() appends the values it hasn't seen yet, sorted among
+  themselves, so `values` is only sorted as a whole after a single call.
+  """
+  def __init__(self, values = ()):
+    self.codes = array('l')
+    self.values = []
+    self.index = {}
+    self.extend(values)
+
+  def extend(self, values):
+    # Encoding a whole column at once keeps the per row work in C
+    index = self.index
+    new = sorted(set(values).difference(index))
+    index.update(zip(new, xrange(len(self.values), len(self.values) + len(new))))
+    self.values.extend(new)
+    self.codes.extend(map(index.__getitem__, values))
+
+  def __len__(self):
+    return len(self.codes)
+
+  def __getitem__(self, i):
+    return self.values[self.codes[i]]
+
+  def __iter__(self):
+    values = self.values
+    return (values[code] for code in self.codes)
+
+
+class Table(object):
+  """
+  Named columns of equal length, in order.
+  """
+  def __init__(self, name, columns):
+    self.name = name
+    self.columns = OrderedDict(columns)
+
+  def __len__(self):
+    for column in self.columns.itervalues():
+      return len(column)
+    return 0
+
+  def __getitem__(self, name):
+    return self.columns[name]
+
+  def rows(self):
+    return iter(zip(*self.columns.values()))
+
+  def write_csv(self, f):
+    """
+    Write the table, with a header row, to the file object `f` as UTF-8 CSV.
+    """
+    writer = csv.writer(f)
+    writer.writerow(self.columns.keys())
+    for row in self.rows():
+      writer.writerow([isinstance(value, unicode) and value.encode('utf-8') or value
+                       for value in row])
+
+  def arrays(self):
+    """
+    The columns as NumPy arrays, keyed '<table>.<column>'; string columns
+    as '<table>.<column>.codes' and '<table>.<column>.values'.
+    """
+    result = OrderedDict()
+    for name, column in self.columns.iteritems():
+      key = '%s.%s' % (self.name, name)
+      if isinstance(column, StringColumn):
+        result[key + '.codes'] = numpy.frombuffer(column.codes, dtype=column.codes.typecode)
+        result[key + '.values'] = numpy.array(column.values, dtype=unicode)
+      else:
+        result[key] = numpy.frombuffer(column, dtype=column.typecode)
+    return result
+
+
+class FeedExport(object):
+  def __init__(self):
+    self.transactions = Table('transactions', [
+      ('id', StringColumn()), ('customer_id', StringColumn()),
+      ('date', StringColumn()), ('order_total', array('d'))])
+    self.details = Table('details', [
+      ('transaction', array('l')), ('product_code', StringColumn()),
+      ('product_name', StringColumn()), ('price', array('d')),
+      ('quantity', array('l'))])
+    self.options = Table('options', [
+      ('detail', array('l')), ('name', StringColumn()), ('value', StringColumn())])
+    self.custom_fields = Table('custom_fields', [
+      ('transaction', array('l')), ('name', StringColumn()), ('value', StringColumn())])
+
+  @property
+  def tables(self):
+    return [self.transactions, self.details, self.options, self.custom_fields]
+
+  def add(self, transactions):
+    """
+    Append the rows for an iterable of Transaction records.
+    """
+    # Gathered as lists first and encoded column by column at the end
+    tx_ids, tx_customers, tx_dates = [], [], []
+    d_codes, d_names, o_names, o_values, c_names, c_values = [], [], [], [], [], []
+    tx_total = self.transactions['order_total']
+    d_tx, d_price, d_quantity = [self.details[name] for name in ('transaction', 'price', 'quantity')]
+    o_detail = self.options['detail']
+    c_tx = self.custom_fields['transaction']
+    row = len(self.transactions)
+    detail_row = len(self.details)
+    for transaction in transactions:
+      tx_ids.append(transaction.id)
+      tx_customers.append(transaction.customer_id)
+      tx_dates.append(_day(transaction))
+      tx_total.append(_float(transaction.order_total))
+      for name, value in transaction.custom_fields.iteritems():
+        c_tx.append(row)
+        c_names.append(name)
+        c_values.append(value)
+      for item in transaction.items:
+        d_tx.append(row)
+        d_codes.append(item.product_code)
+        d_names.append(item.product_name)
+        d_price.append(_float(item.product_price))
+        d_quantity.append(_int(item.product_quantity))
+        for name, value in item.options:
+          o_detail.append(detail_row)
+          o_names.append(name)
+          o_values.append(value)
+        detail_row += 1
+      row += 1
+    for table, name, values in [
+        (self.transactions, 'id', tx_ids), (self.transactions, 'customer_id', tx_customers),
+        (self.transactions, 'date', tx_dates), (self.details, 'product_code', d_codes),
+        (self.details, 'product_name', d_names), (self.options, 'name', o_names),
+        (self.options, 'value', o_values), (self.custom_fields, 'name', c_names),
+        (self.custom_fields, 'value', c_values)]:
+      table[name].extend(values)
+    return self
+
+  def save_npz(self, f):
+    """
+    Save every table's arrays (see Table.arrays) to a compressed .npz file.
+    """
+    arrays = OrderedDict()
+    for table in self.tables:
+      arrays.update(table.arrays())
+    numpy.savez_compressed(f, **arrays)
+
+
+def export_transactions(transactions):
+  """
+  A FeedExport of an iterable of Transaction records.
+  """
+  return FeedExport().add(transactions)
+
+
+def group_sum(keys, weights = None):
+  """
+  {value: total of `weights`} over the rows of the StringColumn `keys`, or
+  {value: row count} without weights.
+  """
+  if numpy is not None:
+    codes = numpy.frombuffer(keys.codes, dtype=keys.codes.typecode)
+    totals = numpy.bincount(codes, weights, minlength=len(keys.values)).tolist()
+  else:
+    totals = [0] * len(keys.values)
+    if weights is None:
+      for code in keys.codes:
+        totals[code] += 1
+    else:
+      for code, weight in zip(keys.codes, weights):
+        totals[code] += weight
+  return dict(zip(keys.values, totals))
+
+
+def revenue_by_product(export):
+  """
+  {product_code: sum of price * quantity} over every transaction detail.
+  """
+  details = export.details
+  if numpy is not None:
+    revenue = (numpy.frombuffer(details['price'], dtype='d') *
+               numpy.frombuffer(details['quantity'], dtype=details['quantity'].typecode))
+  else:
+    revenue = [price * quantity for price, quantity in
+               zip(details['price'], details['quantity'])]
+  return group_sum(details['product_code'], revenue)
+
+
+def counts_by_date(export):
+  """
+  {'YYYY-MM-DD': number of transactions} by transaction date.
+  """
+  return group_sum(export.transactions['date'])
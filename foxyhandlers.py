@@ -0,0 +1,94 @@
+"""
+Registry of the callables that receive the transactions of each datafeed.
+
+Handlers are called with a list of FoxyData.Transaction objects, at most
+batch_size at a time (FOXYCART_HANDLER_BATCH_SIZE, 500 by default), so they
+can do bulk database work instead of one query per transaction.  Register
+them either in settings:
+
+  FOXYCART_TRANSACTION_HANDLERS = ['myshop.orders.save_orders']
+
+or with the decorator:
+
+  @foxyhandlers.register(batch_size=100)
+  def save_orders(transactions):
+    ...
+"""
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+import foxymetrics
+
+_registry = []
+_settings_handlers = None
+
+
+def register(handler = None, batch_size = None):
+  """
+  Register `handler`; usable as @register or @register(batch_size=N).
+  """
+  def decorator(handler):
+    _registry.append((handler, batch_size))
+    return handler
+  if handler is None:
+    return decorator
+  return decorator(handler)
+
+
+def unregister(handler):
+  _registry[:] = [entry for entry in _registry if entry[0] is not handler]
+
+
+def _load_settings_handlers():
+  global _settings_handlers
+  if _settings_handlers is None:
+    handlers = []
+    for path in getattr(settings, 'FOXYCART_TRANSACTION_HANDLERS', ()):
+      module_name, attr = path.rsplit('.', 1)
+      handlers.append((getattr(import_module(module_name), attr), None))
+    _settings_handlers = handlers
+  return _settings_handlers
+
+
+def get_handlers():
+  """
+  All handlers as (callable, batch_size) pairs; settings handlers first.
+  """
+  return _load_settings_handlers() + _registry
+
+
+def _metric_name(handler):
+  return 'handler.%s.%s' % (getattr(handler, '__module__', None),
+                            getattr(handler, '__name__', type(handler).__name__))
+
+
+def _call(handler, metric, batch):
+  with foxymetrics.timer(metric):
+    handler(batch)
+
+
+def dispatch(transactions, handlers = None, batch_size = None):
+  """
+  Pass `transactions` (any iterable, consumed once) to every handler in
+  batches, preserving feed order.  Returns the number of transactions.
+  """
+  if handlers is None:
+    handlers = get_handlers()
+  if batch_size is None:
+    batch_size = getattr(settings, 'FOXYCART_HANDLER_BATCH_SIZE', 500)
+  handlers = [(handler, size or batch_size, [], _metric_name(handler))
+              for handler, size in handlers]
+
+  count = 0
+  for transaction in transactions:
+    count += 1
+    for handler, size, batch, metric in handlers:
+      batch.append(transaction)
+      if len(batch) >= size:
+        _call(handler, metric, batch[:])
+        del batch[:]
+  for handler, size, batch, metric in handlers:
+    if batch:
+      _call(handler, metric, batch)
+  return count
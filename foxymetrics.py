@@ -0,0 +1,200 @@
+"""
+Timings and counters for the datafeed path.
+
+Set FOXYCART_METRICS to choose where they go:
+
+  'logging'  log lines on the foxycart.foxymetrics logger
+  'statsd'   statsd UDP packets to FOXYCART_STATSD_HOST:FOXYCART_STATSD_PORT
+             (default 127.0.0.1:8125), names prefixed with
+             FOXYCART_STATSD_PREFIX (default 'foxycart')
+  'memory'   kept in a MemorySink, mostly useful in tests
+
+or to the dotted path of a sink class.  When it is unset, recording a
+metric is a single attribute check.
+
+Metrics recorded:
+  datafeed.payload_bytes, datafeed.transactions            gauges
+  datafeed.unquote, .decrypt, .parse, .dispatch, .total    timings (ms)
+  handler.<module>.<function>                              timings (ms)
+  datafeed.rejected.<limit>                                counts of feeds over a
+                                                           FeedLimits limit
+"""
+
+import time
+import socket
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class NullSink(object):
+  enabled = False
+
+  def timing(self, name, ms):
+    pass
+
+  def gauge(self, name, value):
+    pass
+
+  def incr(self, name, count = 1):
+    pass
+
+
+class LoggingSink(NullSink):
+  enabled = True
+
+  def __init__(self, logger = log, level = logging.INFO):
+    self.logger = logger
+    self.level = level
+
+  def timing(self, name, ms):
+    self.logger.log(self.level, "%s %.3fms", name, ms)
+
+  def gauge(self, name, value):
+    self.logger.log(self.level, "%s %s", name, value)
+
+  def incr(self, name, count = 1):
+    self.logger.log(self.level, "%s +%d", name, count)
+
+
+class StatsdSink(NullSink):
+  """
+  Fire-and-forget statsd packets over UDP; send errors are ignored.
+  """
+  enabled = True
+
+  def __init__(self, host = '127.0.0.1', port = 8125, prefix = 'foxycart'):
+    self.address = (host, port)
+    self.prefix = prefix and prefix + '.' or ''
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def send(self, name, value, kind):
+    try:
+      self.socket.sendto('%s%s:%s|%s' % (self.prefix, name, value, kind), self.address)
+    except socket.error:
+      pass
+
+  def timing(self, name, ms):
+    self.send(name, '%.3f' % ms, 'ms')
+
+  def gauge(self, name, value):
+    self.send(name, value, 'g')
+
+  def incr(self, name, count = 1):
+    self.send(name, count, 'c')
+
+
+class MemorySink(NullSink):
+  """
+  Keeps every metric as a (kind, name, value) tuple in `records`.
+  """
+  enabled = True
+
+  def __init__(self):
+    self.records = []
+
+  def timing(self, name, ms):
+    self.records.append(('timing', name, ms))
+
+  def gauge(self, name, value):
+    self.records.append(('gauge', name, value))
+
+  def incr(self, name, count = 1):
+    self.records.append(('incr', name, count))
+
+  def values(self, name):
+    return [value for kind, record_name, value in self.records if record_name == name]
+
+
+SINKS = {
+  'logging': LoggingSink,
+  'memory': MemorySink,
+}
+
+_sink = None
+
+def _sink_from_settings():
+  # Imported here so foxyutils, which records metrics, works without Django
+  from django.conf import settings
+  from django.core.exceptions import ImproperlyConfigured
+  from django.utils.importlib import import_module
+  try:
+    name = getattr(settings, 'FOXYCART_METRICS', None)
+  except ImproperlyConfigured:
+    return NullSink()
+  if not name:
+    return NullSink()
+  if name == 'statsd':
+    return StatsdSink(getattr(settings, 'FOXYCART_STATSD_HOST', '127.0.0.1'),
+                      getattr(settings, 'FOXYCART_STATSD_PORT', 8125),
+                      getattr(settings, 'FOXYCART_STATSD_PREFIX', 'foxycart'))
+  if name in SINKS:
+    return SINKS[name]()
+  module_name, attr = name.rsplit('.', 1)
+  return getattr(import_module(module_name), attr)()
+
+
+def get_sink():
+  global _sink
+  if _sink is None:
+    try:
+      _sink = _sink_from_settings()
+    except ImportError:
+      # No Django or no settings (benchmarks, scripts): nothing to report to
+      _sink = NullSink()
+  return _sink
+
+
+def set_sink(sink):
+  """
+  Replace the sink (None to go back to the settings); returns the old one.
+  """
+  global _sink
+  old, _sink = _sink, sink
+  return old
+
+
+class _Timer(object):
+  def __init__(self, sink, name):
+    self.sink = sink
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.sink.timing(self.name, (time.time() - self.start) * 1000)
+
+
+class _NullTimer(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+  """
+  Context manager recording how long its block took as timing `name`.
+  """
+  sink = get_sink()
+  if not sink.enabled:
+    return _null_timer
+  return _Timer(sink, name)
+
+
+def gauge(name, value):
+  sink = get_sink()
+  if sink.enabled:
+    sink.gauge(name, value)
+
+
+def incr(name, count = 1):
+  sink = get_sink()
+  if sink.enabled:
+    sink.incr(name, count)
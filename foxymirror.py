@@ -0,0 +1,96 @@
+"""
+Local mirror of the store's transactions, for reports and queries that
+should not go to the FoxyCart API.
+
+sync_transactions() pages through the transaction_list action and upserts
+the transactions into the MirroredTransaction model in batches.  Only
+transactions from the day of the last synced transaction onwards
+(transaction_date_filter_begin) are downloaded, and progress is saved
+after every batch so an interrupted sync resumes instead of starting over.
+Run it daily with "python manage.py foxy_sync".
+"""
+
+import json
+
+from foxyapi import get_client, iter_list
+from models import MirroredTransaction, SyncState, atomic
+
+SYNC_NAME = 'transaction_list'
+
+
+def mirror_fields(transaction):
+  """
+  MirroredTransaction field values for a Transaction record.
+  """
+  details = [{'product_code': item.product_code,
+              'subscription_startdate': unicode(item.subscription_startdate or ''),
+              'next_transaction_date': unicode(item.next_transaction_date or ''),
+              'options': item.detail}
+             for item in transaction.items]
+  return {'date': transaction.date,
+          'customer_id': transaction.customer_id,
+          'custom_fields': json.dumps(transaction.custom_fields, sort_keys=True),
+          'details': json.dumps(details, sort_keys=True)}
+
+
+def upsert_transactions(transactions, batch_size = 500):
+  """
+  Insert or update a batch of transactions.  Rows already mirrored are
+  deleted and inserted again with the new ones, so the whole batch takes
+  one DELETE and one bulk INSERT per `batch_size` transactions, all in
+  one database transaction.
+  """
+  rows = dict((transaction.id, mirror_fields(transaction)) for transaction in transactions)
+  ids = rows.keys()
+  with atomic():
+    for start in xrange(0, len(ids), batch_size):
+      MirroredTransaction.objects.filter(transaction_id__in=ids[start:start + batch_size]).delete()
+    MirroredTransaction.objects.bulk_create(
+      [MirroredTransaction(transaction_id=transaction_id, **fields)
+       for transaction_id, fields in rows.items()], batch_size=batch_size)
+
+
+def sync_transactions(client = None, full = False, batch_size = 500):
+  """
+  Bring the mirror up to date and return the number of transactions
+  downloaded.  With `full` everything is downloaded again.
+  """
+  client = client or get_client()
+  state = SyncState.objects.get_or_create(name=SYNC_NAME)[0]
+  if full:
+    state.high_water = state.resume_high_water = None
+    state.resume_start = 1
+    state.save()
+
+  filters = {}
+  if state.high_water is not None:
+    # The filter has day granularity; that day's transactions are upserted again
+    filters['transaction_date_filter_begin'] = state.high_water.strftime('%Y-%m-%d')
+  high_water = state.resume_high_water or state.high_water
+  start = state.resume_start
+
+  def checkpoint(batch):
+    # The batch and the progress past it are saved together
+    with atomic():
+      upsert_transactions(batch)
+      state.resume_start += len(batch)
+      state.resume_high_water = high_water
+      state.save()
+
+  batch = []
+  for transaction in iter_list(client, 'transaction_list', filters, prefetch=True, start=start):
+    if transaction.date is not None and (high_water is None or transaction.date > high_water):
+      high_water = transaction.date
+    batch.append(transaction)
+    if len(batch) >= batch_size:
+      checkpoint(batch)
+      batch = []
+  if batch:
+    checkpoint(batch)
+
+  count = state.resume_start - start
+  state.high_water = high_water
+  state.resume_start = 1
+  state.resume_high_water = None
+  state.save()
+  return count
@@ -0,0 +1,258 @@
+"""
+Durable spool and worker pool for processing datafeeds outside of the
+request that delivered them.
+
+With FOXYCART_DATAFEED_ASYNC enabled the foxyfeed view only writes the
+payload to a local sqlite spool and answers "foxy"; decrypting, parsing and
+handling the transactions happens on a pool of worker threads (or
+processes).  Payloads stay in the spool until they have been processed.  A
+failed payload is retried with exponential backoff until it has had
+`max_attempts`; after that it stays in the spool, is logged and counted
+(datafeed.spool.exhausted) and is listed by FeedSpool.exhausted().
+
+Every spool owner keeps a heartbeat in the spool; the rows of an owner
+whose heartbeat has gone stale are taken over and replayed by a live one.
+"""
+
+import os
+import time
+import uuid
+import Queue
+import logging
+import sqlite3
+import threading
+import multiprocessing
+
+from django.conf import settings
+
+import foxymetrics
+
+log = logging.getLogger(__name__)
+
+
+class FeedSpool(object):
+  """
+  sqlite backed store of payloads that have been acknowledged to FoxyCart
+  but not processed yet.  Every row is owned by the spool that added it,
+  identified by a token unique to that process (its pid alone is not: pids
+  are reused, notably across container restarts).
+  """
+  def __init__(self, path, owner = None):
+    self.path = path
+    self.owner = owner or '%d-%s' % (os.getpid(), uuid.uuid4().hex)
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS feed_spool ("
+                    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " owner TEXT NOT NULL,"
+                    " received REAL NOT NULL,"
+                    " attempts INTEGER NOT NULL DEFAULT 0,"
+                    " payload BLOB NOT NULL)")
+    self.db.execute("CREATE TABLE IF NOT EXISTS feed_spool_owner ("
+                    " owner TEXT PRIMARY KEY,"
+                    " heartbeat REAL NOT NULL)")
+    self.heartbeat()
+
+  def heartbeat(self):
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO feed_spool_owner (owner, heartbeat)"
+                      " VALUES (?, ?)", (self.owner, time.time()))
+
+  def add(self, payload):
+    with self.lock:
+      cursor = self.db.execute(
+        "INSERT INTO feed_spool (owner, received, payload) VALUES (?, ?, ?)",
+        (self.owner, time.time(), sqlite3.Binary(payload)))
+      return cursor.lastrowid
+
+  def remove(self, feed_id):
+    with self.lock:
+      self.db.execute("DELETE FROM feed_spool WHERE id = ?", (feed_id,))
+
+  def failed(self, feed_id):
+    """
+    Count a failed attempt; returns the attempts made so far.
+    """
+    with self.lock:
+      self.db.execute("UPDATE feed_spool SET attempts = attempts + 1 WHERE id = ?",
+                      (feed_id,))
+      row = self.db.execute("SELECT attempts FROM feed_spool WHERE id = ?",
+                            (feed_id,)).fetchone()
+      return row and row[0] or 0
+
+  def recover(self, max_attempts, lease):
+    """
+    Take over the rows of owners without a heartbeat in the last `lease`
+    seconds and return those with attempts left as (id, attempts, payload),
+    oldest first.
+    """
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        live = set(row[0] for row in self.db.execute(
+          "SELECT owner FROM feed_spool_owner WHERE heartbeat >= ?", (time.time() - lease,)))
+        live.add(self.owner)
+        dead = [row[0] for row in self.db.execute("SELECT DISTINCT owner FROM feed_spool")
+                if row[0] not in live]
+        recovered = []
+        for owner in dead:
+          recovered.extend(self.db.execute(
+            "SELECT id, attempts, payload FROM feed_spool"
+            " WHERE owner = ? AND attempts < ?", (owner, max_attempts)))
+          self.db.execute("UPDATE feed_spool SET owner = ? WHERE owner = ?", (self.owner, owner))
+          self.db.execute("DELETE FROM feed_spool_owner WHERE owner = ?", (owner,))
+        self.db.execute("COMMIT")
+      except Exception:
+        self.db.execute("ROLLBACK")
+        raise
+      return [(feed_id, attempts, str(payload)) for feed_id, attempts, payload in sorted(recovered)]
+
+  def exhausted(self, max_attempts):
+    """
+    (id, received, attempts) of the rows that are out of attempts.
+    """
+    with self.lock:
+      return list(self.db.execute("SELECT id, received, attempts FROM feed_spool"
+                                  " WHERE attempts >= ? ORDER BY id", (max_attempts,)))
+
+  def __len__(self):
+    with self.lock:
+      return self.db.execute("SELECT COUNT(*) FROM feed_spool").fetchone()[0]
+
+
+class FeedWorkerPool(object):
+  """
+  Runs `process(payload)` for spooled payloads on `workers` threads fed by a
+  queue of at most `queue_size` entries.  When the queue stays full for
+  `put_timeout` seconds, submit() gives up and returns False so the caller
+  can push back on FoxyCart instead of acknowledging.  With
+  `use_processes` the threads hand the work to a multiprocessing.Pool;
+  `process` must then be a picklable module level function.
+
+  A payload that fails is queued again after `retry_delay` seconds,
+  doubling with every attempt, up to `max_attempts` attempts.  Every
+  `lease` / 3 seconds the pool renews its heartbeat and takes over the
+  rows of owners whose heartbeat is older than `lease`.
+  """
+  def __init__(self, process, spool, workers = 4, queue_size = 100,
+               put_timeout = 5, use_processes = False, max_attempts = 3,
+               retry_delay = 30, lease = 60):
+    self.process = process
+    self.spool = spool
+    self.queue = Queue.Queue(queue_size)
+    self.put_timeout = put_timeout
+    self.max_attempts = max_attempts
+    self.retry_delay = retry_delay
+    self.lease = lease
+    self.pool = use_processes and multiprocessing.Pool(workers) or None
+    self.threads = []
+    for i in range(workers):
+      thread = threading.Thread(target=self.work, name='foxyfeed-worker-%d' % i)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def start(self):
+    """
+    Replay whatever an earlier process left in the spool, and keep
+    watching for owners that die while this one runs.
+    """
+    self.recover()
+    thread = threading.Thread(target=self.keep_alive, name='foxyfeed-heartbeat')
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def recover(self):
+    """
+    Start replaying the rows taken over from dead owners; returns the
+    replay thread, or None when there was nothing to take over.
+    """
+    pending = self.spool.recover(self.max_attempts, self.lease)
+    if not pending:
+      return None
+    log.info("Replaying %d spooled datafeeds", len(pending))
+    thread = threading.Thread(target=self.replay, args=(pending,),
+                              name='foxyfeed-replay')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def keep_alive(self):
+    while True:
+      time.sleep(self.lease / 3.0)
+      try:
+        self.spool.heartbeat()
+        self.recover()
+      except Exception:
+        log.exception("Datafeed spool heartbeat failed")
+
+  def replay(self, pending):
+    for feed_id, attempts, payload in pending:
+      self.queue.put((feed_id, payload))
+
+  def retry_later(self, feed_id, payload, attempts):
+    timer = threading.Timer(self.retry_delay * 2 ** (attempts - 1),
+                            self.queue.put, ((feed_id, payload),))
+    timer.daemon = True
+    timer.start()
+
+  def submit(self, payload):
+    feed_id = self.spool.add(payload)
+    try:
+      self.queue.put((feed_id, payload), timeout=self.put_timeout)
+    except Queue.Full:
+      self.spool.remove(feed_id)
+      return False
+    return True
+
+  def work(self):
+    while True:
+      feed_id, payload = self.queue.get()
+      try:
+        if self.pool is not None:
+          self.pool.apply(self.process, (payload,))
+        else:
+          self.process(payload)
+      except Exception:
+        log.exception("Processing spooled datafeed %s failed", feed_id)
+        attempts = self.spool.failed(feed_id)
+        if attempts < self.max_attempts:
+          self.retry_later(feed_id, payload, attempts)
+        else:
+          log.error("Giving up on spooled datafeed %s after %d attempts; it is left"
+                    " in %s", feed_id, attempts, self.spool.path)
+          foxymetrics.incr('datafeed.spool.exhausted')
+      else:
+        self.spool.remove(feed_id)
+      finally:
+        self.queue.task_done()
+
+  def join(self):
+    self.queue.join()
+
+
+_feed_pool = None
+_feed_pool_lock = threading.Lock()
+
+def get_feed_pool(process):
+  """
+  Return the process wide worker pool, creating it from the settings (and
+  replaying the spool) on first use.
+  """
+  global _feed_pool
+  with _feed_pool_lock:
+    if _feed_pool is None:
+      spool = FeedSpool(getattr(settings, 'FOXYCART_DATAFEED_SPOOL',
+                                os.path.join(os.path.dirname(__file__), 'spool.sqlite')))
+      _feed_pool = FeedWorkerPool(
+        process, spool,
+        workers=getattr(settings, 'FOXYCART_DATAFEED_WORKERS', 4),
+        queue_size=getattr(settings, 'FOXYCART_DATAFEED_QUEUE_SIZE', 100),
+        put_timeout=getattr(settings, 'FOXYCART_DATAFEED_QUEUE_TIMEOUT', 5),
+        use_processes=getattr(settings, 'FOXYCART_DATAFEED_POOL', 'thread') == 'process',
+        max_attempts=getattr(settings, 'FOXYCART_DATAFEED_MAX_ATTEMPTS', 3),
+        retry_delay=getattr(settings, 'FOXYCART_DATAFEED_RETRY_DELAY', 30),
+      ).start()
+    return _feed_pool
@@ -0,0 +1,88 @@
+"""
+A local stand-in for the FoxyCart API, for tests and benchmarks.
+
+  server = StubFoxyServer({'category_list': '<foxydata>...</foxydata>'}).start()
+  client = FoxyClient(server.url, 'key')
+  ...
+  server.stop()
+
+Responses map an api_action to a body, or to a callable taking the request
+parameters and returning a body or a (status, body) pair.  The server speaks
+HTTP/1.1 keep-alive and counts the connections it accepted; `connect_delay`
+stands in for the cost of a TCP/TLS handshake to the real API.
+"""
+
+import time
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+SUCCESS = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<foxydata><result>SUCCESS</result>'
+           '<messages><message>OK</message></messages></foxydata>')
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers are written one at a time; don't let Nagle hold them back
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    with self.server.stub.lock:
+      self.server.stub.connections += 1
+    if self.server.stub.connect_delay:
+      time.sleep(self.server.stub.connect_delay)
+
+  def do_POST(self):
+    stub = self.server.stub
+    length = int(self.headers.getheader('content-length') or 0)
+    params = dict(urlparse.parse_qsl(self.rfile.read(length), keep_blank_values=True))
+    action = params.get('api_action')
+    with stub.lock:
+      stub.requests.append(params)
+
+    response = stub.responses.get(action, SUCCESS)
+    if callable(response):
+      response = response(params)
+    status, body = isinstance(response, tuple) and response or (200, response)
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/xml')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class StubFoxyServer(object):
+  def __init__(self, responses = None, port = 0, connect_delay = 0):
+    self.responses = responses or {}
+    self.connect_delay = connect_delay
+    self.requests = []
+    self.connections = 0
+    self.lock = threading.Lock()
+    self.server = _Server(('127.0.0.1', port), _Handler)
+    self.server.stub = self
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d/api' % self.server.server_address[1]
+
+  def start(self):
+    thread = threading.Thread(target=self.server.serve_forever, name='foxystub')
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
@@ -0,0 +1,181 @@
+"""
+In-memory store of the subscriptions from FoxyCart's subscription datafeed.
+
+Subscriptions are indexed by sub_token, customer_id, the product codes of
+their transaction template and next_transaction_date, so billing jobs can
+ask for what is due without scanning every record:
+
+  store = get_store()
+  store.upsert_all(FoxyData.from_crypted_str(payload, key).subscriptions)
+  for subscription in store.due_within(7):
+    ...
+
+Feeds arriving at the datafeed view are upserted into the process wide
+store returned by get_store().
+"""
+
+import bisect
+import threading
+from decimal import Decimal, InvalidOperation
+from datetime import date, datetime, timedelta
+
+
+def _as_datetime(value):
+  if isinstance(value, datetime):
+    return value
+  return datetime(value.year, value.month, value.day)
+
+
+def _past_due(subscription):
+  try:
+    return Decimal(subscription.past_due_amount or 0) > 0
+  except InvalidOperation:
+    return False
+
+
+class SubscriptionStore(object):
+  """
+  Subscription records indexed for lookups and date range queries.  Only
+  active subscriptions (is_active other than '0') are in the due index.
+  upsert() replaces the record with the same sub_token.
+  """
+  def __init__(self, subscriptions = ()):
+    self.lock = threading.RLock()
+    self.by_token = {}
+    self.by_customer = {}
+    self.by_product = {}
+    self.past_due_tokens = set()
+    # Sorted (next_transaction_date, sub_token) pairs
+    self.due = []
+    self.upsert_all(subscriptions)
+
+  def __len__(self):
+    return len(self.by_token)
+
+  def __iter__(self):
+    return iter(self.by_token.values())
+
+  def __contains__(self, sub_token):
+    return sub_token in self.by_token
+
+  def get(self, sub_token):
+    return self.by_token.get(sub_token)
+
+  def _due_key(self, subscription):
+    if subscription.is_active == '0' or subscription.next_transaction_date is None:
+      return None
+    return (subscription.next_transaction_date, subscription.sub_token)
+
+  def _index(self, subscription):
+    token = subscription.sub_token
+    self.by_token[token] = subscription
+    self.by_customer.setdefault(subscription.customer_id, set()).add(token)
+    for item in subscription.items:
+      self.by_product.setdefault(item.product_code, set()).add(token)
+    if _past_due(subscription):
+      self.past_due_tokens.add(token)
+
+  def _unindex(self, subscription):
+    token = subscription.sub_token
+    del self.by_token[token]
+    for index, key in [(self.by_customer, subscription.customer_id)] + \
+                      [(self.by_product, item.product_code) for item in subscription.items]:
+      tokens = index.get(key)
+      if tokens is not None:
+        tokens.discard(token)
+        if not tokens:
+          del index[key]
+    self.past_due_tokens.discard(token)
+
+  def _remove_due(self, subscription):
+    key = self._due_key(subscription)
+    if key is not None:
+      i = bisect.bisect_left(self.due, key)
+      if i < len(self.due) and self.due[i] == key:
+        del self.due[i]
+
+  def upsert(self, subscription):
+    with self.lock:
+      old = self.by_token.get(subscription.sub_token)
+      if old is not None:
+        self._remove_due(old)
+        self._unindex(old)
+      self._index(subscription)
+      key = self._due_key(subscription)
+      if key is not None:
+        bisect.insort(self.due, key)
+
+  def upsert_all(self, subscriptions):
+    """
+    upsert() for a whole feed, rebuilding the due index once at the end.
+    """
+    with self.lock:
+      for subscription in subscriptions:
+        old = self.by_token.get(subscription.sub_token)
+        if old is not None:
+          self._unindex(old)
+        self._index(subscription)
+      self.due = sorted(key for key in map(self._due_key, self.by_token.itervalues())
+                        if key is not None)
+
+  def remove(self, sub_token):
+    with self.lock:
+      subscription = self.by_token.get(sub_token)
+      if subscription is not None:
+        self._remove_due(subscription)
+        self._unindex(subscription)
+      return subscription
+
+  def for_customer(self, customer_id):
+    with self.lock:
+      return [self.by_token[token] for token in self.by_customer.get(customer_id, ())]
+
+  def for_product(self, product_code):
+    with self.lock:
+      return [self.by_token[token] for token in self.by_product.get(product_code, ())]
+
+  def due_between(self, start, end):
+    """
+    Active subscriptions whose next_transaction_date is in [start, end),
+    ordered by that date.
+    """
+    with self.lock:
+      lo = bisect.bisect_left(self.due, (_as_datetime(start),))
+      hi = bisect.bisect_left(self.due, (_as_datetime(end),))
+      return [self.by_token[token] for day, token in self.due[lo:hi]]
+
+  def due_within(self, days, today = None):
+    """
+    Active subscriptions due from `today` through `days` days later.
+    """
+    today = _as_datetime(today or date.today())
+    return self.due_between(today, today + timedelta(days=days + 1))
+
+  def overdue(self, today = None):
+    """
+    Active subscriptions whose next_transaction_date is before `today`.
+    """
+    with self.lock:
+      hi = bisect.bisect_left(self.due, (_as_datetime(today or date.today()),))
+      return [self.by_token[token] for day, token in self.due[:hi]]
+
+  def past_due(self):
+    """
+    Subscriptions with a past_due_amount above zero.
+    """
+    with self.lock:
+      return [self.by_token[token] for token in self.past_due_tokens]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+  """
+  The process wide store the datafeed view keeps up to date.
+  """
+  global _store
+  with _store_lock:
+    if _store is None:
+      _store = SubscriptionStore()
+    return _store
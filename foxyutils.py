@@ -1,8 +1,23 @@
 """
 Utilities for decrypting and parsing a FoxyCart datafeed.
 """
+import re
+import sys
+import urllib
+import threading
+import multiprocessing
 from xml.dom.minidom import parseString
+from xml.parsers import expat
 from datetime import datetime
+from collections import namedtuple
+from binascii import hexlify, unhexlify
+
+import foxymetrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
  
 # Thanks, Wikipedia: http://en.wikipedia.org/wiki/RC4#Implementation
 class ARC4:
@@ -30,64 +45,884 @@ class ARC4:
             r = self.state[(self.state[self.x] + self.state[self.y]) & 0xFF]
             output[i] = chr(ord(input[i]) ^ r)
         return ''.join(output)
+
+
+def _as_buffer(data):
+    # unicode input (e.g. straight out of request.POST) holds one byte per
+    # character, exactly as ARC4.crypt treats it with ord().
+    if isinstance(data, unicode):
+        return data.encode('latin-1')
+    return data
+
+
+_IDENTITY = str(bytearray(range(256)))
+
+
+def _key_bytes(key):
+    if isinstance(key, basestring):
+        return bytearray(ord(c) & 0xFF for c in key)
+    return bytearray(key)
+
+
+def _xor_long(data, keystream):
+    if not len(data):
+        return ''
+    value = long(hexlify(data), 16) ^ long(hexlify(keystream), 16)
+    return unhexlify('%0*x' % (len(data) * 2, value))
+
+
+def _xor_numpy(data, keystream):
+    if isinstance(data, memoryview):
+        # Python 2 numpy.frombuffer only takes old style buffers
+        data = data.tobytes()
+    return (numpy.frombuffer(data, dtype=numpy.uint8) ^
+            numpy.frombuffer(keystream, dtype=numpy.uint8)).tostring()
+
+
+class FastARC4(object):
+    """
+    Block oriented RC4 producing the same output as ARC4.  Accepts str,
+    bytearray or memoryview input; the keystream is generated one block at a
+    time and XORed over the whole block at once, using NumPy when it is
+    installed and Python long integers otherwise.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, key = None, use_numpy = None):
+        self.state = bytearray(_IDENTITY)
+        self.x = self.y = 0
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self.xor = use_numpy and _xor_numpy or _xor_long
+
+        if key is not None:
+            self.init(key)
+
+    # Post-KSA state (as a str) by key, shared by for_key()
+    _schedules = {}
+    _schedules_lock = threading.Lock()
+    max_cached_keys = 16
+
+    @classmethod
+    def for_key(cls, key, use_numpy = None):
+        """
+        A cipher for `key` starting from a copy of its cached key schedule,
+        so the KSA only runs the first time a key is seen.
+        """
+        cache_key = key if isinstance(key, str) else str(_key_bytes(key))
+        state = cls._schedules.get(cache_key)
+        if state is None:
+            state = str(cls(cache_key).state)
+            with cls._schedules_lock:
+                if len(cls._schedules) >= cls.max_cached_keys:
+                    cls._schedules.clear()
+                cls._schedules[cache_key] = state
+        cipher = cls(use_numpy=use_numpy)
+        cipher.state = bytearray(state)
+        return cipher
+
+    # KSA
+    def init(self, key):
+        key = _key_bytes(key)
+        state = self.state
+        key_len = len(key)
+        j = 0
+        for i in xrange(256):
+            j = (j + state[i] + key[i % key_len]) & 0xFF
+            state[i], state[j] = state[j], state[i]
+        self.x = self.y = 0
+
+    # PRGA
+    def keystream(self, length):
+        state = self.state
+        x, y = self.x, self.y
+        output = bytearray(length)
+        for i in xrange(length):
+            x = (x + 1) & 0xFF
+            sx = state[x]
+            y = (y + sx) & 0xFF
+            sy = state[y]
+            state[x] = sy
+            state[y] = sx
+            output[i] = state[(sx + sy) & 0xFF]
+        self.x, self.y = x, y
+        return output
+
+    def crypt(self, input):
+        data = _as_buffer(input)
+        if isinstance(data, memoryview) and data.itemsize != 1:
+            data = memoryview(data.tobytes())
+        size = self.block_size
+        output = []
+        for start in xrange(0, len(data), size):
+            block = data[start:start + size]
+            output.append(self.xor(block, self.keystream(len(block))))
+        return ''.join(output)
+
+
+class FeedLimitExceeded(ValueError):
+    """
+    Raised when a datafeed goes over one of its FeedLimits; `limit` is
+    'bytes', 'transactions', 'depth' or 'doctype'.
+    """
+    def __init__(self, limit, value):
+        ValueError.__init__(self, limit, value)
+        self.limit = limit
+        self.value = value
+
+    def __str__(self):
+        return "Datafeed over its %s limit (%s)" % (self.limit, self.value)
+
+
+class FeedLimits(object):
+    """
+    Bounds on one datafeed, None for none: `max_bytes` of ciphertext,
+    `max_transactions` records and `max_depth` levels of element nesting.
+    A feed parsed under limits may not have a DOCTYPE, and so no entity
+    declarations to expand.
+    """
+    def __init__(self, max_bytes = None, max_transactions = None, max_depth = None):
+        self.max_bytes = max_bytes
+        self.max_transactions = max_transactions
+        self.max_depth = max_depth
+
+    def check(self, limit, value):
+        maximum = getattr(self, 'max_' + limit)
+        if maximum is not None and value > maximum:
+            raise FeedLimitExceeded(limit, value)
+
+
+class DecryptingReader(object):
+    """
+    Read-only file-like wrapper that decrypts an RC4 ciphertext stream as it
+    is read, so the plaintext never has to be held in memory as a whole.
+    Raises FeedLimitExceeded once more than limits.max_bytes have been read.
+    """
+    def __init__(self, stream, crypt_key, limits = None):
+        self.stream = stream
+        self.cipher = FastARC4.for_key(crypt_key)
+        self.limits = limits
+        self.bytes_read = 0
+
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        if self.limits is not None:
+            self.bytes_read += len(data)
+            self.limits.check('bytes', self.bytes_read)
+        return self.cipher.crypt(data)
+
+
+class _Unquoter(object):
+  """
+  urllib.unquote_plus for data arriving in pieces; an escape split between
+  two pieces is held back until the rest of it arrives.
+  """
+  def __init__(self):
+    self.pending = ''
+
+  def feed(self, data, final = False):
+    data = self.pending + data
+    self.pending = ''
+    if not final:
+      cut = data.find('%', max(len(data) - 2, 0))
+      if cut != -1:
+        data, self.pending = data[:cut], data[cut:]
+    return urllib.unquote_plus(data)
+
+
+_FIELD_END = re.compile('[=&]')
+
+def read_form_field(stream, name, unquotes = 1, bufsize = 64 * 1024, max_size = None):
+  """
+  Read the value of field `name` from the application/x-www-form-urlencoded
+  body in file-like `stream` into a bytearray, url decoding it `unquotes`
+  times as it streams past.  Only one `bufsize` chunk of the body is held
+  at a time and other fields are skipped undecoded.  Returns None if the
+  body has no such field.  FeedLimitExceeded is raised as soon as the
+  decoded value is longer than `max_size`.
+  """
+  value = None
+  name_parts = []
+  in_name, wanted = True, False
+  while True:
+    chunk = stream.read(bufsize)
+    pos = 0
+    while pos < len(chunk):
+      if in_name:
+        match = _FIELD_END.search(chunk, pos)
+        if match is None:
+          name_parts.append(chunk[pos:])
+          break
+        name_parts.append(chunk[pos:match.start()])
+        pos = match.end()
+        if match.group() == '=':
+          in_name = False
+          wanted = value is None and urllib.unquote_plus(''.join(name_parts)) == name
+          if wanted:
+            value = bytearray()
+            decoders = [_Unquoter() for i in range(unquotes)]
+        name_parts = []
+      else:
+        end = chunk.find('&', pos)
+        if wanted:
+          piece = chunk[pos:end == -1 and len(chunk) or end]
+          for decoder in decoders:
+            piece = decoder.feed(piece)
+          value.extend(piece)
+          if max_size is not None and len(value) > max_size:
+            raise FeedLimitExceeded('bytes', len(value))
+        if end == -1:
+          break
+        if wanted:
+          _flush(decoders, value)
+        in_name, wanted = True, False
+        pos = end + 1
+    if not chunk:
+      break
+  if wanted:
+    _flush(decoders, value)
+  return value
+
+
+def _flush(decoders, value):
+  piece = ''
+  for decoder in decoders:
+    piece = decoder.feed(piece, True)
+  value.extend(piece)
  
  
-class FoxyData:
-  DateFmt = '%Y-%m-%d'
-  DateTimeFmt = '%Y-%m-%d %H:%M:%S'
- 
-  class Transaction:
-    def __init__(self, node):
-      def extract_kv_node(node, key_name):
-        el = node.getElementsByTagName(key_name)
-        return len(el) > 0 and el[0].firstChild.data or ''
- 
-      self.id = extract_kv_node(node, 'id')
-      self.date = datetime.strptime(
-       extract_kv_node(node, 'transaction_date'), FoxyData.DateTimeFmt)
-      self.customer_id = extract_kv_node(node, 'customer_id')
- 
-      self.attributes = attrs = {}
-      self.items = items = attrs['items'] = []
- 
-      self.custom_fields = attrs['custom_fields'] = {}
-      for custom_field in node.getElementsByTagName('custom_field'):
-        self.custom_fields[extract_kv_node(custom_field, 'custom_field_name')] = \
-         extract_kv_node(custom_field, 'custom_field_value')
- 
-      self.transaction_details = attrs['detail'] = []
-      for details in node.getElementsByTagName('transaction_detail'):
-        item = {'product_code': extract_kv_node(details, 'product_code')}
+TransactionDetailOption = namedtuple('TransactionDetailOption', 'name value')
+
+
+_MISSING = object()
+
+
+class FixedDateParser(object):
+  """
+  Parser for the fixed 'YYYY-MM-DD' and 'YYYY-MM-DD HH:MM:SS' formats used
+  in the datafeed (FoxyData.DateFmt and FoxyData.DateTimeFmt).  It slices
+  the text and calls the datetime constructor directly instead of going
+  through strptime, returns None for empty or invalid values rather than
+  raising, and memoizes results since refeeds repeat the same dates a lot.
+  The memo is simply emptied once it holds `maxsize` entries.
+  """
+  DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+  def __init__(self, with_time, maxsize = 4096):
+    if with_time:
+      self.pattern = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$')
+    else:
+      self.pattern = re.compile(r'\d{4}-\d\d-\d\d$')
+    self.with_time = with_time
+    self.maxsize = maxsize
+    self.memo = {}
+
+  def __call__(self, text):
+    # Failed parses are memoized as None, hence the sentinel; a miss is the
+    # common case for datetimes, so it must not cost an exception.
+    value = self.memo.get(text, _MISSING)
+    if value is not _MISSING:
+      return value
+    if len(self.memo) >= self.maxsize:
+      self.memo.clear()
+    value = self.memo[text] = self.parse(text)
+    return value
+
+  def parse(self, text):
+    if not text or not self.pattern.match(text):
+      return None
+    year, month, day = int(text[0:4]), int(text[5:7]), int(text[8:10])
+    if not (year and 1 <= month <= 12 and 1 <= day <= self.DAYS_IN_MONTH[month]):
+      return None
+    if month == 2 and day == 29 and not (year % 4 == 0 and (year % 100 or year % 400 == 0)):
+      return None
+    if not self.with_time:
+      return datetime(year, month, day)
+    hour, minute, second = int(text[11:13]), int(text[14:16]), int(text[17:19])
+    if hour > 23 or minute > 59 or second > 59:
+      return None
+    return datetime(year, month, day, hour, minute, second)
+
+
+parse_date = FixedDateParser(with_time=False)
+parse_datetime = FixedDateParser(with_time=True)
+
+
+def _lazy_date_property(slot, keep_text = False):
+  """
+  Property over a slot holding feed text until the first read, when it is
+  replaced by the parsed date.  With `keep_text` a value that does not parse
+  stays as the feed text; otherwise it reads as None.
+  """
+  def getter(self):
+    value = getattr(self, slot)
+    if isinstance(value, basestring):
+      parsed = value and parse_date(value)
+      if parsed or not keep_text:
+        value = parsed or None
+        setattr(self, slot, value)
+    return value
+  def setter(self, value):
+    setattr(self, slot, value)
+  return property(getter, setter)
+
+
+class Transaction(object):
+  """
+  Compact record for one <transaction>.  transaction_date is kept as text
+  and only turned into a datetime (and cached) when `date` is first read;
+  an empty or invalid date reads as None.  order_total is the feed text.
+  """
+  __slots__ = ('id', 'customer_id', 'order_total', 'custom_fields', 'items', '_date')
+
+  def __init__(self):
+    self.id = ''
+    self.customer_id = ''
+    self.order_total = ''
+    self.custom_fields = {}
+    self.items = []
+    self._date = ''
+
+  def _get_date(self):
+    if isinstance(self._date, basestring):
+      self._date = parse_datetime(self._date)
+    return self._date
+
+  def _set_date(self, value):
+    self._date = value
+
+  date = property(_get_date, _set_date)
+
+  @property
+  def transaction_details(self):
+    return self.items
+
+  @property
+  def attributes(self):
+    return {'items': self.items, 'custom_fields': self.custom_fields,
+            'detail': self.items}
+
+
+class TransactionDetail(object):
+  """
+  Compact record for one <transaction_detail>.  It also answers to the dict
+  interface the detail records used to have, so item['product_code'] and
+  item['detail'] keep working.  The product name, price and quantity are
+  plain attributes holding the feed text, outside that interface.
+  """
+  __slots__ = ('product_code', 'product_name', 'product_price', 'product_quantity',
+               'options', '_subscription_startdate', '_next_transaction_date')
+
+  fields = ('product_code', 'subscription_startdate', 'next_transaction_date',
+            'detail')
+
+  def __init__(self):
+    self.product_code = self.product_name = ''
+    self.product_price = self.product_quantity = ''
+    self.options = []
+    self._subscription_startdate = self._next_transaction_date = ''
+
+  # A value that does not parse is left as the feed text, as the dict based
+  # records used to do.
+  subscription_startdate = _lazy_date_property('_subscription_startdate', keep_text=True)
+  next_transaction_date = _lazy_date_property('_next_transaction_date', keep_text=True)
+
+  def _get_detail(self):
+    return dict(self.options)
+
+  def _set_detail(self, value):
+    self.options = [TransactionDetailOption(k, v) for k, v in value.items()]
+
+  detail = property(_get_detail, _set_detail)
+
+  def __getitem__(self, key):
+    if key not in self.fields:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def __setitem__(self, key, value):
+    if key not in self.fields:
+      raise KeyError(key)
+    setattr(self, key, value)
+
+  def __contains__(self, key):
+    return key in self.fields
+
+  def __iter__(self):
+    return iter(self.fields)
+
+  def __len__(self):
+    return len(self.fields)
+
+  def get(self, key, default = None):
+    if key in self.fields:
+      return getattr(self, key)
+    return default
+
+  def keys(self):
+    return list(self.fields)
+
+  def items(self):
+    return [(key, getattr(self, key)) for key in self.fields]
+
+
+class Customer(object):
+  """
+  Compact record for one <customer> of a customer_list response.
+  """
+  __slots__ = ('id', 'email', 'first_name', 'last_name')
+
+  def __init__(self):
+    self.id = self.email = self.first_name = self.last_name = ''
+
+
+class Subscription(object):
+  """
+  Compact record for one <subscription>.  `items` and `custom_fields` come
+  from its transaction template; the dates are parsed on first access.
+  """
+  __slots__ = ('sub_token', 'customer_id', 'frequency', 'past_due_amount',
+               'is_active', 'items', 'custom_fields', '_start_date',
+               '_next_transaction_date', '_end_date')
+
+  def __init__(self):
+    self.sub_token = self.customer_id = self.frequency = ''
+    self.past_due_amount = self.is_active = ''
+    self.items = []
+    self.custom_fields = {}
+    self._start_date = self._next_transaction_date = self._end_date = ''
+
+  start_date = _lazy_date_property('_start_date')
+  next_transaction_date = _lazy_date_property('_next_transaction_date')
+  end_date = _lazy_date_property('_end_date')
+
+
+class FeedParser(object):
+  """
+  Single pass, event driven builder of FoxyData records: transactions from
+  datafeeds and transaction_list responses, customers and subscriptions
+  from the other list responses.  Every element is visited once and
+  dispatched by (parent tag, tag) through the precomputed field tables
+  below, so the cost is linear in the size of the feed.  Data may be fed
+  incrementally; finished records collect in `records` until drained.
+  API responses also fill in `result`, `messages` and `statistics`.
+
+  `fields`, a set of record attribute paths ('id', 'customer_id',
+  'custom_fields', 'items', 'items.product_code', 'items.options', ...),
+  restricts parsing to those fields; the others keep their empty defaults.
+  Subtrees holding none of them (custom fields, transaction details,
+  detail options) are skipped without building anything.
+
+  With FeedLimits, FeedLimitExceeded is raised as soon as the records or
+  the nesting go over them, or at a DOCTYPE.
+  """
+  def __init__(self, fields = None, limits = None):
+    self.parser = parser = expat.ParserCreate()
+    parser.buffer_text = True
+    self.skip_tags = ()
+    if fields is not None:
+      self.project(fields)
+    self.limits = limits
+    if limits is not None:
+      self.record_count = 0
+      self.max_records = limits.max_transactions is None and sys.maxint or limits.max_transactions
+      self.max_depth = limits.max_depth is None and sys.maxint or limits.max_depth
+      parser.StartDoctypeDeclHandler = self.reject_doctype
+    self._handle_elements()
+    self.skip_depth = 0
+    self.stack = [None]
+    self.text = []
+    self.records = []
+    self.record = self.item = self.pair = None
+    self.result = None
+    self.messages = []
+    self.statistics = {}
+
+  def project(self, fields):
+    fields = set(fields)
+    unknown = fields.difference(self.field_paths.itervalues())
+    if unknown:
+      raise ValueError("Unknown fields: %s" % ', '.join(sorted(unknown)))
+    # 'items' stands for every items.* field, and any items.* needs 'items'
+    if 'items' in fields:
+      fields.update(path for path in self.field_paths.itervalues()
+                    if path.startswith('items.'))
+    elif any(path.startswith('items.') for path in fields):
+      fields.add('items')
+    self.end_handlers = dict((key, handler) for key, handler in self.end_handlers.iteritems()
+                             if key not in self.field_paths or self.field_paths[key] in fields)
+    self.skip_tags = frozenset(tag for tag, path in self.subtree_paths.iteritems()
+                               if path not in fields)
+
+  def _handle_elements(self):
+    parser = self.parser
+    parser.StartElementHandler = self.limits and self.limited_start_element or self.start_element
+    parser.EndElementHandler = self.end_element
+    parser.CharacterDataHandler = self.character_data
+
+  def _skip_elements(self):
+    parser = self.parser
+    parser.StartElementHandler = self.limits and self.limited_skip_start or self.skip_start
+    parser.EndElementHandler = self.skip_end
+    parser.CharacterDataHandler = None
+
+  def feed(self, data, final = False):
+    self.parser.Parse(data, final)
+
+  def drain(self):
+    records, self.records = self.records, []
+    return records
+
+  def start_element(self, tag, attrs):
+    if tag in self.skip_tags:
+      self.skip_depth = 1
+      self._skip_elements()
+      return
+    handler = self.start_handlers.get(tag)
+    if handler is not None:
+      handler(self)
+    self.stack.append(tag)
+    self.text = []
+
+  def end_element(self, tag):
+    self.stack.pop()
+    handler = self.end_handlers.get((self.stack[-1], tag))
+    if handler is not None:
+      handler(self, u''.join(self.text))
+    self.text = []
+
+  def character_data(self, data):
+    self.text.append(data)
+
+  # Inside a skipped subtree only its depth is tracked
+  def skip_start(self, tag, attrs):
+    self.skip_depth += 1
+
+  # start_element and skip_start checking the FeedLimits first
+  def limited_start_element(self, tag, attrs):
+    if len(self.stack) > self.max_depth:
+      raise FeedLimitExceeded('depth', len(self.stack))
+    if tag in self.skip_tags:
+      self.skip_depth = 1
+      self._skip_elements()
+      return
+    handler = self.start_handlers.get(tag)
+    if handler is not None:
+      if tag in self.record_tags:
+        self.record_count += 1
+        if self.record_count > self.max_records:
+          raise FeedLimitExceeded('transactions', self.record_count)
+      handler(self)
+    self.stack.append(tag)
+    self.text = []
+
+  def limited_skip_start(self, tag, attrs):
+    self.skip_depth += 1
+    if len(self.stack) + self.skip_depth - 1 > self.max_depth:
+      raise FeedLimitExceeded('depth', len(self.stack) + self.skip_depth - 1)
+
+  def reject_doctype(self, name, *args):
+    raise FeedLimitExceeded('doctype', name)
+
+  def skip_end(self, tag):
+    self.skip_depth -= 1
+    if not self.skip_depth:
+      self._handle_elements()
+      self.text = []
+
+  def start_record(record_class):
+    def start(self):
+      self.record = record_class()
+    return start
+
+  def start_detail(self):
+    self.item = TransactionDetail()
+
+  def start_pair(self):
+    self.pair = ['', '']
+
+  def end_record(self, text):
+    self.records.append(self.record)
+    self.record = None
+
+  def end_custom_field(self, text):
+    self.record.custom_fields[self.pair[0]] = self.pair[1]
+
+  def end_detail(self, text):
+    self.record.items.append(self.item)
+
+  def end_detail_option(self, text):
+    self.item.options.append(TransactionDetailOption(*self.pair))
+
+  def end_result(self, text):
+    self.result = text
+
+  def end_message(self, text):
+    self.messages.append(text)
+
+  def set_attr(target, name):
+    def setter(self, text):
+      setattr(getattr(self, target), name, text)
+    return setter
+
+  def set_key(target, key):
+    def setter(self, text):
+      getattr(self, target)[key] = text
+    return setter
+
+  start_handlers = {
+    'transaction': start_record(Transaction),
+    'customer': start_record(Customer),
+    'subscription': start_record(Subscription),
+    'custom_field': start_pair,
+    'transaction_detail': start_detail,
+    'transaction_detail_option': start_pair,
+  }
+
+  end_handlers = {
+    ('foxydata', 'result'): end_result,
+    ('messages', 'message'): end_message,
+    ('statistics', 'filtered_total'): set_key('statistics', 'filtered_total'),
+    ('statistics', 'pagination_start'): set_key('statistics', 'pagination_start'),
+    ('statistics', 'pagination_end'): set_key('statistics', 'pagination_end'),
+
+    ('transactions', 'transaction'): end_record,
+    ('transaction', 'id'): set_attr('record', 'id'),
+    ('transaction', 'transaction_date'): set_attr('record', 'date'),
+    ('transaction', 'customer_id'): set_attr('record', 'customer_id'),
+    ('transaction', 'order_total'): set_attr('record', 'order_total'),
+
+    ('customers', 'customer'): end_record,
+    ('customer', 'customer_id'): set_attr('record', 'id'),
+    ('customer', 'customer_email'): set_attr('record', 'email'),
+    ('customer', 'customer_first_name'): set_attr('record', 'first_name'),
+    ('customer', 'customer_last_name'): set_attr('record', 'last_name'),
+
+    ('subscriptions', 'subscription'): end_record,
+    ('subscription', 'sub_token'): set_attr('record', 'sub_token'),
+    ('subscription', 'customer_id'): set_attr('record', 'customer_id'),
+    ('subscription', 'start_date'): set_attr('record', 'start_date'),
+    ('subscription', 'next_transaction_date'): set_attr('record', 'next_transaction_date'),
+    ('subscription', 'end_date'): set_attr('record', 'end_date'),
+    ('subscription', 'frequency'): set_attr('record', 'frequency'),
+    ('subscription', 'past_due_amount'): set_attr('record', 'past_due_amount'),
+    ('subscription', 'is_active'): set_attr('record', 'is_active'),
+
+    ('custom_fields', 'custom_field'): end_custom_field,
+    ('custom_field', 'custom_field_name'): set_key('pair', 0),
+    ('custom_field', 'custom_field_value'): set_key('pair', 1),
+    ('transaction_details', 'transaction_detail'): end_detail,
+    ('transaction_detail', 'product_code'): set_attr('item', 'product_code'),
+    ('transaction_detail', 'product_name'): set_attr('item', 'product_name'),
+    ('transaction_detail', 'product_price'): set_attr('item', 'product_price'),
+    ('transaction_detail', 'product_quantity'): set_attr('item', 'product_quantity'),
+    ('transaction_detail', 'subscription_startdate'): set_attr('item', 'subscription_startdate'),
+    ('transaction_detail', 'next_transaction_date'): set_attr('item', 'next_transaction_date'),
+    ('transaction_detail_options', 'transaction_detail_option'): end_detail_option,
+    ('transaction_detail_option', 'product_option_name'): set_key('pair', 0),
+    ('transaction_detail_option', 'product_option_value'): set_key('pair', 1),
+  }
+
+  # The field path each end handler fills in, for projections.  Handlers
+  # not listed here (records, results, statistics) always run.
+  field_paths = {
+    ('transaction', 'id'): 'id',
+    ('transaction', 'transaction_date'): 'date',
+    ('transaction', 'customer_id'): 'customer_id',
+    ('transaction', 'order_total'): 'order_total',
+    ('customer', 'customer_id'): 'id',
+    ('customer', 'customer_email'): 'email',
+    ('customer', 'customer_first_name'): 'first_name',
+    ('customer', 'customer_last_name'): 'last_name',
+    ('custom_fields', 'custom_field'): 'custom_fields',
+    ('custom_field', 'custom_field_name'): 'custom_fields',
+    ('custom_field', 'custom_field_value'): 'custom_fields',
+    ('transaction_details', 'transaction_detail'): 'items',
+    ('transaction_detail', 'product_code'): 'items.product_code',
+    ('transaction_detail', 'product_name'): 'items.product_name',
+    ('transaction_detail', 'product_price'): 'items.product_price',
+    ('transaction_detail', 'product_quantity'): 'items.product_quantity',
+    ('transaction_detail', 'subscription_startdate'): 'items.subscription_startdate',
+    ('transaction_detail', 'next_transaction_date'): 'items.next_transaction_date',
+    ('transaction_detail_options', 'transaction_detail_option'): 'items.options',
+    ('transaction_detail_option', 'product_option_name'): 'items.options',
+    ('transaction_detail_option', 'product_option_value'): 'items.options',
+  }
+  for key in end_handlers:
+    if key[0] == 'subscription':
+      field_paths[key] = key[1]
+  del key
+
+  # Subtrees skipped when their field is not projected.  shipto_addresses
+  # holds nothing the records keep.
+  subtree_paths = {
+    'custom_fields': 'custom_fields',
+    'transaction_details': 'items',
+    'transaction_detail_options': 'items.options',
+    'shipto_addresses': None,
+  }
+  subtree_order = ['transaction_details', 'transaction_detail_options',
+                   'custom_fields', 'shipto_addresses']
+
+  record_tags = frozenset(['transaction', 'customer', 'subscription'])
+
+  del start_record, set_attr, set_key
+
+
+def strip_elements(markup, tags):
+  """
+  `markup` without the <tag>...</tag> elements of `tags`, which must not
+  nest inside themselves.  Cut out with string searches, which is much
+  cheaper than having the parser walk through them.  Tags not always
+  written exactly so (with attributes, spaces or as <tag/>) are left for
+  the parser, and so is all of markup with CDATA sections, comments,
+  processing instructions or a DOCTYPE, where text could look like a tag.
+  """
+  if '<!' in markup or markup.find('<?', 1) != -1:
+    return markup
+  for tag in tags:
+    start_tag, end_tag = '<%s>' % tag, '</%s>' % tag
+    if (markup.count('<' + tag) != markup.count(start_tag) or
+        markup.count('</' + tag) != markup.count(end_tag)):
+      continue
+    pieces = []
+    pos = 0
+    while True:
+      start = markup.find(start_tag, pos)
+      if start == -1:
+        break
+      end = markup.find(end_tag, start)
+      if end == -1:
+        break
+      pieces.append(markup[pos:start])
+      pos = end + len(end_tag)
+    if pieces:
+      pieces.append(markup[pos:])
+      markup = markup[:0].join(pieces)
+  return markup
+
+
+def parse_records(markup, fields = None, limits = None):
+  parser = FeedParser(fields, limits)
+  if parser.skip_tags:
+    # Outermost first, so nested ones go with them
+    markup = strip_elements(markup, sorted(parser.skip_tags,
+                                           key=FeedParser.subtree_order.index))
+  parser.feed(markup, True)
+  return parser.drain()
+
+
+def _parse_chunk(args):
+  return parse_records(*args)
+
+
+def split_feed(markup, parts):
+  """
+  Split `markup` at <transaction> boundaries into at most `parts` complete
+  documents of about equal size, each with the original header and footer.
+  The boundaries are found with string searches, so markup where text could
+  look like a tag (CDATA sections, comments, processing instructions) is
+  returned whole, as is markup whose first or last transaction isn't
+  written plainly as <transaction>...</transaction>.
+  """
+  if parts < 2 or '<!' in markup or markup.find('<?', 1) != -1:
+    return [markup]
+  first = markup.find('<transaction>')
+  last = markup.rfind('</transaction>')
+  if first == -1 or last == -1:
+    return [markup]
+  last += len('</transaction>')
+  head, tail = markup[:first], markup[last:]
+  # Anything like a transaction outside of them would go into every part
+  if head.count('<transaction') != head.count('<transactions>') or '<transaction' in tail:
+    return [markup]
+  step = (last - first) // parts + 1
+  chunks = []
+  start = first
+  while start < last:
+    end = markup.find('<transaction>', min(start + step, last))
+    if end == -1 or end > last:
+      end = last
+    chunks.append(''.join([head, markup[start:end], tail]))
+    start = end
+  return chunks
+
+# Feeds smaller than this are not worth shipping to other processes
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+
+_parse_pools = {}
+
+def parse_parallel(markup, processes, fields = None, limits = None):
+  """
+  parse_records() spread over a pool of `processes` worker processes,
+  returning the records in feed order.
+  """
+  pool = _parse_pools.get(processes)
+  if pool is None:
+    pool = _parse_pools[processes] = multiprocessing.Pool(processes)
+  chunks = split_feed(markup, processes * 2)
+  if len(chunks) == 1:
+    return parse_records(markup, fields, limits)
+  if limits is not None:
+    # Without CDATA or comments every <transaction> is a record, so this
+    # can only undercount; it rejects big feeds before the workers start
+    limits.check('transactions', markup.count('<transaction>'))
+  records = []
+  for chunk in pool.map(_parse_chunk, [(chunk, fields, limits) for chunk in chunks], 1):
+    records.extend(chunk)
+  if limits is not None:
+    # The workers only see their own part of the feed
+    limits.check('transactions', len(records))
+  return records
  
-        for key in ['subscription_startdate', 'next_transaction_date']:
-          date_str = extract_kv_node(details, key)
-          try:
-            item[key] = datetime.strptime(date_str, FoxyData.DateFmt)
-          except ValueError:
-            item[key] = date_str
  
-        detail = item['detail'] = {}
-        for detail_opt in details.getElementsByTagName('transaction_detail_option'):
-          detail[extract_kv_node(detail_opt, 'product_option_name')] = \
-           extract_kv_node(detail_opt, 'product_option_value')
+class FoxyData(object):
+  DateFmt = '%Y-%m-%d'
+  DateTimeFmt = '%Y-%m-%d %H:%M:%S'
  
-        items.append(item)
+  # The record types live at module level so they can be pickled
+  Transaction = Transaction
+  TransactionDetail = TransactionDetail
+  TransactionDetailOption = TransactionDetailOption
+  Customer = Customer
+  Subscription = Subscription
  
-  def __init__(self, markup):
+  def __init__(self, markup, processes = 1, min_size = PARALLEL_MIN_SIZE, fields = None,
+               limits = None):
+    """
+    With `processes` > 1, feeds of at least `min_size` bytes are parsed on
+    that many worker processes.  `fields` limits parsing to a projection
+    (see FeedParser), e.g. fields=['id', 'customer_id'], and `limits` is
+    a FeedLimits to parse under.
+    """
     self.markup = markup
-    self.doc = parseString(self.markup)
-    self.transactions = []
- 
-    for transaction in self.doc.getElementsByTagName('transaction'):
-      self.transactions.append(FoxyData.Transaction(transaction))
+    self._doc = None
+    with foxymetrics.timer('datafeed.parse'):
+      if processes > 1 and len(markup) >= min_size:
+        records = parse_parallel(markup, processes, fields, limits)
+      else:
+        records = parse_records(markup, fields, limits)
+    # Subscription datafeeds hold <subscription> records instead
+    self.subscriptions = [r for r in records if r.__class__ is Subscription]
+    if self.subscriptions:
+      records = [r for r in records if r.__class__ is not Subscription]
+    self.transactions = records
+    foxymetrics.gauge('datafeed.transactions', len(self.transactions))
+
+  @property
+  def doc(self):
+    # Parsing no longer goes through a DOM; build one only if asked for
+    if self._doc is None:
+      self._doc = parseString(self.markup)
+    return self._doc
  
   def __str__(self):
     return str(self.markup)
  
  
   @classmethod
-  def from_str(self, data_str):
-    return FoxyData(data_str)
+  def from_str(self, data_str, **options):
+    return FoxyData(data_str, **options)
  
   """
   Given a string containing RC4-crypted FoxyCart datafeed XML and the
@@ -95,14 +930,39 @@ class FoxyData:
   containing all of the Transactions in the data feed.
   """
   @classmethod
-  def from_crypted_str(self, data_str, crypt_key):
-    a = ARC4(crypt_key)
-    return FoxyData.from_str(a.crypt(data_str))
+  def from_crypted_str(self, data_str, crypt_key, **options):
+    limits = options.get('limits')
+    if limits is not None:
+      limits.check('bytes', len(data_str))
+    with foxymetrics.timer('datafeed.decrypt'):
+      markup = FastARC4.for_key(crypt_key).crypt(data_str)
+    return FoxyData.from_str(markup, **options)
  
   @classmethod
   def decrypt_str(self, data_str, crypt_key):
-    a = ARC4(crypt_key)
+    a = FastARC4.for_key(crypt_key)
     return a.crypt(data_str)
+
+  @classmethod
+  def iter_transactions(self, stream, crypt_key, bufsize = 64 * 1024, fields = None,
+                        limits = None):
+    """
+    Decrypt and parse a datafeed read from the file-like `stream`, yielding
+    each Transaction as soon as its <transaction> element has been read.
+    Only one transaction subtree is held in memory at a time.
+    """
+    reader = DecryptingReader(stream, crypt_key, limits)
+    parser = FeedParser(fields, limits)
+    while True:
+      chunk = reader.read(bufsize)
+      if not chunk:
+        break
+      parser.feed(chunk)
+      for transaction in parser.drain():
+        yield transaction
+    parser.feed('', True)
+    for transaction in parser.drain():
+      yield transaction
  
   def __len__(self):
     return len(self.transactions)
@@ -22,15 +22,19 @@ A tool that allows you to send commands to the foxycart api
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import urllib2
-import urllib
-from django.conf import settings
+import sys
+import json
+import shlex
+from optparse import make_option
+from collections import namedtuple
+
 from django.core.management.base import BaseCommand, CommandError
 
-# It should be noted that this code is succeptable to man in the middle attacks due
-# to sending the https request via urllib2 which does not verify certificates.
-# Certificate verification should be added as described here:
-# http://thejosephturner.com/blog/2011/03/19/https-certificate-verification-in-python-with-urllib2/
+from foxycart.foxyapi import get_client, run_batch, RateLimiter
+
+# Requests go through foxyapi.FoxyClient, which uses httplib.  Only Python
+# 2.7.9 and later verify https certificates there; on older versions this
+# code is succeptable to man in the middle attacks.
 
 # foxycart commands from the .72 API
 # see http://wiki.foxycart.com/v/0.7.2/api
@@ -308,31 +312,65 @@ as passed in as the type)'}],
       }
     ]
 
+# foxy_commands compiled into an index by command name, so validating a call
+# is a dictionary lookup and a couple of set operations.
+CommandSpec = namedtuple('CommandSpec', 'name required allowed definition')
+
+def compile_commands(commands):
+    index = {}
+    for c in commands:
+        required = tuple(a['name'] for a in c['required_arguments'])
+        optional = tuple(a['name'] for a in c['optional_arguments'])
+        index[c['command']] = CommandSpec(c['command'], required,
+                                          frozenset(required + optional), c)
+    return index
+
+command_index = compile_commands(foxy_commands)
+
+def validate_arguments(name, args_d):
+    """
+    Return a message describing what is wrong with calling command `name`
+    with the arguments in `args_d`, or None if the call is valid.
+    """
+    spec = command_index.get(name)
+    if spec is None:
+        return "command '{0}' not found.".format(name)
+    # Check that we have all required fields
+    for a in spec.required:
+        if a not in args_d:
+            return "required argument '{0}' must be supplied.".format(a)
+    # Check that all arguments are valid for the command
+    unknown = args_d.viewkeys() - spec.allowed
+    if unknown:
+        return "Unknown argument '{0}'".format(min(unknown))
+    return None
+
 class Command(BaseCommand):
     args = 'command [help] [option=value]...'
     help = 'Sends a command to the foxycart api'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', dest='batch', metavar='FILE',
+                    help='Run the actions in FILE ("-" for stdin), one per line, written either as '
+                    'a JSON object with a "command" key or as "command option=value ...".  '
+                    'Results are written as JSON lines in input order.'),
+        make_option('--workers', dest='workers', type='int', default=4,
+                    help='Number of API calls made concurrently in batch mode'),
+        make_option('--rate', dest='rate', type='float', default=0,
+                    help='Maximum number of API calls per second in batch mode (0 for no limit)'),
+        )
+
     def send_foxy_command(self, action, data = {}):
-        data["api_token"] = settings.FOXYCART_DATAFEED_KEY
-        data["api_action"] = action
-        encoded_data = urllib.urlencode( data )
-        response = urllib2.urlopen(settings.FOXYCART_API_URL + '/api', encoded_data)
-        html = response.read()
-        return html
+        """
+        Send `action` and return the foxyapi.FoxyResponse.
+        """
+        return get_client().request(action, data)
 
     def find_command(self, command):
-        for c in foxy_commands:
-            if c['command'] == command:
-                return c
-        return None
+        spec = command_index.get(command)
+        return spec and spec.definition
 
     def command_accepts_argument(self, command, arg):
-        for a in command['required_arguments']:
-            if a['name'] == arg:
-                return True
-        for a in command['optional_arguments']:
-            if a['name'] == arg:
-                return True
-        return False
+        return arg in command_index[command['command']].allowed
 
     def args_to_dictionary(self, args):
         d = {}
@@ -344,6 +382,80 @@ class Command(BaseCommand):
                 d[l[0]] = l[1]
         return d
 
+    def check_arguments(self, command, args_d):
+        """
+        Return a message describing what is wrong with the arguments, or None.
+        """
+        return validate_arguments(command['command'], args_d)
+
+    def parse_batch_line(self, line):
+        """
+        Return (command name, arguments) for one line of a batch file.
+        """
+        if line.startswith('{'):
+            args_d = json.loads(line)
+            name = args_d.pop('command', None)
+            args_d = dict((str(k), unicode(v).encode('utf-8')) for k, v in args_d.items())
+        else:
+            words = shlex.split(line)
+            name = words.pop(0)
+            args_d = {}
+            for item in words:
+                l = item.split('=', 1)
+                if len(l) != 2:
+                    raise ValueError("arguments must be in the form of argument=value")
+                args_d[l[0]] = l[1]
+        return name, args_d
+
+    def read_batch(self, stream):
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                name, args_d = self.parse_batch_line(line)
+            except ValueError, e:
+                yield number, None, {}, "Error in line: {0}".format(e)
+                continue
+            yield number, name, args_d, validate_arguments(name, args_d)
+
+    def handle_batch(self, path, workers, rate):
+        client = get_client()
+        client.pool.size = max(client.pool.size, workers)
+        limiter = RateLimiter(rate)
+
+        def run(item):
+            number, name, args_d, problem = item
+            if problem:
+                return None
+            limiter.wait()
+            return client.request(name, args_d)
+
+        stream = path == '-' and sys.stdin or open(path)
+        failures = total = 0
+        try:
+            for item, response, error in run_batch(run, self.read_batch(stream), workers):
+                number, name, args_d, problem = item
+                result = {'line': number, 'command': name}
+                if problem:
+                    result.update(status='invalid', error=problem)
+                elif error is not None:
+                    result.update(status='error', error=str(error))
+                elif not response.ok:
+                    result.update(status='error', error='; '.join(response.messages),
+                                  http_status=response.http_status, response=response.body)
+                else:
+                    result.update(status='ok', http_status=response.http_status,
+                                  response=response.body)
+                failures += result['status'] != 'ok'
+                total += 1
+                self.stdout.write(json.dumps(result) + "\n")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if failures:
+            raise CommandError("{0} of {1} batch actions failed".format(failures, total))
+
     def print_help_for_command(self, command):
         self.stdout.write("foxy_command: {0}\n".format(command["command"]))
         self.stdout.write("    {0}\n".format(command["help"]))
@@ -357,6 +469,10 @@ class Command(BaseCommand):
                 self.stdout.write("        {0} : {1}\n".format(a["name"], a["info"]))
 
     def handle(self, *args, **options):
+        if options.get('batch'):
+            self.handle_batch(options['batch'], options['workers'], options['rate'])
+            return
+
         if len(args) == 0 or args[0] == 'help':
             self.stdout.write("Usage: foxy_command command [help | command options]\n")
             self.stdout.write("  Available commands (Foxycart API .72):\n")
@@ -377,21 +493,16 @@ class Command(BaseCommand):
 
         args_d = self.args_to_dictionary(args[1:])
 
-        # Check that we have all required fields
-        for a in command['required_arguments']:
-            if not a['name'] in args_d:
-                self.stdout.write("required argument '{0}' must be supplied.\n".format(a['name']))
-                return
-                
-        # Check that all arguments are valid for the command
-        for a in args_d:
-            if not self.command_accepts_argument(command, a):
-                self.stdout.write("Unknown argument '{0}'\n".format(a))
-                return
+        problem = self.check_arguments(command, args_d)
+        if problem:
+            self.stdout.write(problem + "\n")
+            return
         try:
             response = self.send_foxy_command(command['command'], args_d)
         except Exception, e:
             self.stdout.write(e.__str__())
             raise CommandError("Error sending command to foxycart server")
-        self.stdout.write(response)
-        # Should parse the XML and figure out if it was successfull or an error
+        self.stdout.write(response.body)
+        if not response.ok:
+            raise CommandError("foxycart returned an error: {0}".format(
+                '; '.join(response.messages)))
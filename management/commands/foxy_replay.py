@@ -0,0 +1,79 @@
+"""
+Replays captured datafeeds (see foxycapture) through the datafeed pipeline
+"""
+
+import time
+import traceback
+import multiprocessing
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from foxycart import views
+from foxycart.foxyapi import run_batch, RateLimiter
+from foxycart.foxycapture import read_captures, get_capture_log
+from foxycart.foxyutils import FoxyData
+
+def replay_feed(crypted):
+    """
+    Process one captured feed; returns the error, formatted, if it failed.
+    """
+    try:
+        views.process_crypted_feed(crypted)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+class Command(BaseCommand):
+    args = '[capture file or directory]...'
+    help = 'Pushes captured datafeeds through the datafeed handlers, by default those in FOXYCART_CAPTURE_DIR'
+    option_list = BaseCommand.option_list + (
+        make_option('--rate', dest='rate', type='float', default=0,
+                    help='Maximum number of feeds per second (0, the default, for as fast as possible)'),
+        make_option('--workers', dest='workers', type='int', default=4,
+                    help='Number of feeds processed concurrently'),
+        make_option('--processes', dest='processes', action='store_true', default=False,
+                    help='Use worker processes instead of threads'),
+        make_option('--plaintext', dest='plaintext', action='store_true', default=False,
+                    help='Write the decrypted feeds to stdout instead of processing them'),
+        )
+
+    def handle(self, *paths, **options):
+        records = read_captures(paths or [get_capture_log().directory])
+        if options['plaintext']:
+            # The feeds are UTF-8 bytes; Django 1.5+ wraps stdout in an
+            # OutputWrapper that would decode them, so write to the stream it wraps
+            stdout = getattr(self.stdout, '_out', self.stdout)
+            for timestamp, crypted in records:
+                stdout.write(FoxyData.decrypt_str(crypted, settings.FOXYCART_DATAFEED_KEY) + "\n")
+            return
+
+        limiter = RateLimiter(options['rate'])
+        def feeds():
+            for timestamp, crypted in records:
+                limiter.wait()
+                yield crypted
+
+        start = time.time()
+        if options['processes']:
+            pool = multiprocessing.Pool(options['workers'])
+            errors = pool.imap(replay_feed, feeds())
+        else:
+            errors = (result for crypted, result, error in
+                      run_batch(replay_feed, feeds(), options['workers']))
+        total = failures = 0
+        for error in errors:
+            total += 1
+            if error:
+                failures += 1
+                self.stderr.write(error)
+        if options['processes']:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start
+        self.stdout.write("Replayed {0} feeds in {1:.2f}s ({2:.1f} feeds/s)\n".format(
+            total, elapsed, total / max(elapsed, 1e-6)))
+        if failures:
+            raise CommandError("{0} of {1} feeds failed".format(failures, total))
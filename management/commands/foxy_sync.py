@@ -0,0 +1,25 @@
+"""
+Download new FoxyCart transactions into the local mirror (see foxymirror)
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from foxycart.foxymirror import sync_transactions, SYNC_NAME
+from foxycart.models import SyncState
+
+class Command(BaseCommand):
+    help = 'Syncs the local transaction mirror with the foxycart api'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', dest='full', action='store_true', default=False,
+                    help='Download every transaction instead of only the new ones'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help='Number of transactions written to the database at a time'),
+        )
+
+    def handle(self, *args, **options):
+        count = sync_transactions(full=options['full'], batch_size=options['batch_size'])
+        state = SyncState.objects.get(name=SYNC_NAME)
+        self.stdout.write("Synced {0} transactions; latest transaction date {1}\n".format(
+            count, state.high_water))
@@ -0,0 +1,50 @@
+from django.db import models, transaction
+
+
+# transaction.atomic only arrived in Django 1.6; commit_on_success is the
+# nearest thing before it
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
+class SeenTransaction(models.Model):
+  """
+  A transaction id that has already been handled; the persistent side of
+  foxydedup.
+  """
+  transaction_id = models.CharField(max_length=64, unique=True)
+  received = models.DateTimeField(auto_now_add=True)
+
+  def __unicode__(self):
+    return self.transaction_id
+
+
+class MirroredTransaction(models.Model):
+  """
+  Local copy of a transaction, kept up to date by foxymirror from the
+  transaction_list API action.  custom_fields and details hold JSON.
+  """
+  transaction_id = models.CharField(max_length=64, unique=True)
+  date = models.DateTimeField(null=True, db_index=True)
+  customer_id = models.CharField(max_length=64, db_index=True)
+  custom_fields = models.TextField(default='{}')
+  details = models.TextField(default='[]')
+
+  def __unicode__(self):
+    return self.transaction_id
+
+
+class SyncState(models.Model):
+  """
+  Progress of a foxymirror sync.  `high_water` is the latest transaction
+  date of the last complete sync.  While a sync is running, `resume_start`
+  (the next record number) and `resume_high_water` record how far it got,
+  so an interrupted sync carries on where it stopped.
+  """
+  name = models.CharField(max_length=64, unique=True)
+  high_water = models.DateTimeField(null=True)
+  resume_start = models.PositiveIntegerField(default=1)
+  resume_high_water = models.DateTimeField(null=True)
+  updated = models.DateTimeField(auto_now=True)
+
+  def __unicode__(self):
+    return self.name
@@ -4,16 +4,40 @@ Unit test for foxycart.py.
  
 import os
 import sys
+import json
 import codecs
+import socket
 import urllib
+import httplib
+import tempfile
+import threading
+from StringIO import StringIO
+from datetime import datetime
 
-from django.test.client import Client
+from django.test import TestCase
+from django.test.client import Client, RequestFactory
 from django.core.urlresolvers import reverse
+from django.core.management.base import CommandError
 from django.conf import settings
 import unittest
 
 from foxyutils import *
+from foxyqueue import FeedSpool, FeedWorkerPool
+import foxyhandlers
+import foxymetrics
+from foxysubscriptions import SubscriptionStore
+from foxymirror import sync_transactions, upsert_transactions
+from foxycapture import CaptureLog, read_captures
+from foxyexport import export_transactions, revenue_by_product, counts_by_date
+from models import MirroredTransaction, SyncState, SeenTransaction
+from foxydedup import BloomFilter, TransactionDeduplicator
+import time
+from foxyapi import FoxyClient, FoxyResponse, ResponseCache, run_batch, iter_list, FoxyApiError, \
+  response_status
+from foxystub import StubFoxyServer, SUCCESS
 import views
+from management.commands import foxy_command
+from management.commands.foxy_command import command_index, validate_arguments
  
 class Constants:
   pass
@@ -61,12 +85,197 @@ class FoxyDataVectorTest(unittest.TestCase):
   def test_from_str(self):
     vector = FoxyData.from_str(self._get_test_data("testdata.xml"))
     self._test_it_hard(vector)
- 
+
+  def test_nested_id_is_not_transaction_id(self):
+    # The transaction's own <id> comes after detail and option subtrees
+    # holding <id> elements of their own
+    data = self._get_test_data("testdata.xml").replace('<id>616</id>', '')
+    data = data.replace('<transaction_detail>',
+                        '<transaction_detail><id>detail-1</id>')
+    data = data.replace('<transaction_detail_option>',
+                        '<transaction_detail_option><id>option-1</id>')
+    data = data.replace('</transaction_details>', '</transaction_details><id>616</id>')
+    self.assert_(data.index('detail-1') < data.index('<id>616</id>'))
+    self._test_it_hard(FoxyData.from_str(data))
+    # Without its own <id> the transaction's stays empty
+    data = data.replace('<id>616</id>', '')
+    self.assertEqual('', FoxyData.from_str(data).transactions[0].id)
+
   def test_from_crypted_str(self):
     crypted_str = ARC4(Constants.SECRET_KEY).crypt(self._get_test_data("testdata.xml"))
     vector = FoxyData.from_crypted_str(crypted_str, Constants.SECRET_KEY)
     self._test_it_hard(vector)
- 
+
+  def test_iter_transactions(self):
+    crypted_str = ARC4(Constants.SECRET_KEY).crypt(self._get_test_data("testdata.xml"))
+    transactions = list(FoxyData.iter_transactions(StringIO(crypted_str),
+                                                   Constants.SECRET_KEY, bufsize=64))
+    self.assertEqual(1, len(transactions), 'expected one transaction')
+    tx = transactions[0]
+    self.assertEqual('616', tx.id)
+    self.assertEqual('122', tx.customer_id)
+    self.assertEqual('Value123', tx.custom_fields['My_Cool_Text'])
+    self.assertEqual('blue', tx.items[0]['detail']['color'])
+
+  def test_projection(self):
+    data = self._get_test_data("testdata.xml")
+    tx = FoxyData.from_str(data, fields=['id', 'customer_id']).transactions[0]
+    self.assertEqual(('616', '122', {}, [], None),
+                     (tx.id, tx.customer_id, tx.custom_fields, tx.items, tx.date))
+    tx = FoxyData.from_str(data, fields=['items.product_code']).transactions[0]
+    self.assertEqual(('', 'abc123', '', []), (tx.id, tx.items[0].product_code,
+                                              tx.items[0].product_price, tx.items[0].options))
+    self.assertRaises(ValueError, FoxyData.from_str, data, fields=['id', 'no_such_field'])
+    # Tag-like text in CDATA and tags written differently don't fool the skipping
+    cdata = data.replace('<custom_field_value>Value123</custom_field_value>',
+                         '<custom_field_value><![CDATA[<transaction_details>]]></custom_field_value>')
+    self.assertNotEqual(data, cdata)
+    tx = FoxyData.from_str(cdata, fields=['id', 'custom_fields']).transactions[0]
+    self.assertEqual(('616', '<transaction_details>'), (tx.id, tx.custom_fields['My_Cool_Text']))
+    pi = data.replace('</customer_id>', '</customer_id><?note <custom_fields>?>')
+    self.assertNotEqual(data, pi)
+    self.assertEqual('616', FoxyData.from_str(pi, fields=['id']).transactions[0].id)
+    head, rest = data.split('<transaction>', 1)
+    body, tail = rest.split('</transaction>', 1)
+    twice = ''.join([head, '<transaction>',
+                     body.replace('</transaction_details>', '</transaction_details >'),
+                     '</transaction><transaction>', body.replace('<id>616</id>', '<id>617</id>'),
+                     '</transaction>', tail])
+    self.assertEqual(['616', '617'], [tx.id for tx in FoxyData.from_str(twice, fields=['id']).transactions])
+    # Streamed in small pieces the parser skips the subtrees itself
+    crypted_str = ARC4(Constants.SECRET_KEY).crypt(data)
+    tx, = FoxyData.iter_transactions(StringIO(crypted_str), Constants.SECRET_KEY,
+                                     bufsize=64, fields=['custom_fields', 'date'])
+    self.assertEqual(('', 'Value123', [], "2007-05-04"),
+                     (tx.id, tx.custom_fields['My_Cool_Text'], tx.items,
+                      tx.date.strftime(FoxyData.DateFmt)))
+
+  def test_read_form_field(self):
+    crypted_str = ARC4(Constants.SECRET_KEY).crypt(self._get_test_data("testdata.xml"))
+    body = urllib.urlencode([('FoxyData', urllib.quote_plus(crypted_str)), ('other', '1')])
+    for bufsize in (1, 5, 4096):
+      crypted = read_form_field(StringIO(body), 'FoxyData', unquotes=2, bufsize=bufsize)
+      self.assertEqual(crypted_str, str(crypted))
+    vector = FoxyData.from_crypted_str(memoryview(crypted), Constants.SECRET_KEY)
+    self._test_it_hard(vector)
+    self.assertEqual(None, read_form_field(StringIO('other=1&Foxy=2'), 'FoxyData'))
+
+  def test_parse_parallel(self):
+    markup = self._get_test_data("testdata.xml").encode('utf-8')
+    head, rest = markup.split('<transaction>', 1)
+    body, tail = rest.split('</transaction>', 1)
+    markup = ''.join([head] + ['<transaction>' + body.replace('<id>616</id>', '<id>%d</id>' % i) +
+                               '</transaction>' for i in range(25)] + [tail])
+    self.assertEqual(5, len(split_feed(markup, 5)))
+    serial = FoxyData(markup).transactions
+    parallel = FoxyData(markup, processes=2, min_size=0).transactions
+    self.assertEqual([str(i) for i in range(25)], [t.id for t in parallel])
+    fields = lambda t: (t.id, t.date, t.customer_id, t.custom_fields, [i.items() for i in t.items])
+    self.assertEqual(map(fields, serial), map(fields, parallel))
+    self.assertEqual('blue', parallel[-1].items[0]['detail']['color'])
+
+    # Tag-like text in CDATA, or a last transaction written differently, is parsed whole
+    cdata = markup.replace('<custom_field_value>Value123</custom_field_value>',
+                           '<custom_field_value><![CDATA[</transaction><transaction>]]>'
+                           '</custom_field_value>')
+    spaced = markup[::-1].replace('>noitcasnart/<', '> noitcasnart/<', 1)[::-1]
+    for variant in (cdata, spaced):
+      self.assertEqual(1, len(split_feed(variant, 5)))
+      parallel = FoxyData(variant, processes=2, min_size=0).transactions
+      self.assertEqual([str(i) for i in range(25)], [t.id for t in parallel])
+    parallel = FoxyData(cdata, processes=2, min_size=0).transactions
+    self.assertEqual('</transaction><transaction>', parallel[0].custom_fields['My_Cool_Text'])
+
+  def test_metrics(self):
+    crypted_str = ARC4(Constants.SECRET_KEY).crypt(self._get_test_data("testdata.xml"))
+    sink = foxymetrics.MemorySink()
+    old = foxymetrics.set_sink(sink)
+    try:
+      data = FoxyData.from_crypted_str(crypted_str, Constants.SECRET_KEY)
+      foxyhandlers.dispatch(data.transactions, handlers=[(len, None)], batch_size=10)
+    finally:
+      foxymetrics.set_sink(old)
+    self.assertEqual([1], sink.values('datafeed.transactions'))
+    self.assertEqual(['timing', 'timing', 'gauge', 'timing'],
+                     [kind for kind, name, value in sink.records])
+    self.assertEqual(1, len(sink.values('datafeed.decrypt')))
+    self.assertEqual(1, len(sink.values('handler.__builtin__.len')))
+    self.assertEqual(foxymetrics._null_timer, foxymetrics.timer('datafeed.parse'))
+
+  def test_transaction_records(self):
+    tx = FoxyData.from_str(self._get_test_data("testdata.xml")).transactions[0]
+    item = tx.items[0]
+    self.assertEqual(['product_code', 'subscription_startdate',
+                      'next_transaction_date', 'detail'], item.keys())
+    self.assert_('detail' in item)
+    self.assertEqual(None, item.get('product_price'))
+    self.assertRaises(KeyError, lambda: item['product_price'])
+    self.assertEqual([('color', 'blue')], item.options)
+    self.assertEqual(('foo', '20.00', '1'),
+                     (item.product_name, item.product_price, item.product_quantity))
+    self.assertEqual('24.38', tx.order_total)
+    # Dates are parsed on first access and then cached
+    self.assert_(tx.date is tx.date)
+    self.assert_(item['next_transaction_date'] is item.next_transaction_date)
+    self.assertEqual(tx.items, tx.attributes['items'])
+
+  def test_fixed_date_parser(self):
+    self.assertEqual(datetime(2007, 5, 4, 20, 53, 57), parse_datetime('2007-05-04 20:53:57'))
+    self.assertEqual(datetime(2008, 2, 29), parse_date('2008-02-29'))
+    for bad in ['', '2007-02-29', '2007-13-01', '2007-05-04 20:53:57', 'not a date']:
+      self.assertEqual(None, parse_date(bad), bad)
+    self.assertEqual(None, parse_datetime('2007-05-04 24:00:00'))
+    # Failed parses are memoized too and served from the memo
+    parser = FixedDateParser(with_time=False)
+    parser.parse = lambda text, parse=parser.parse: parsed.append(text) or parse(text)
+    parsed = []
+    self.assertEqual([None, None, datetime(2008, 2, 29), datetime(2008, 2, 29)],
+                     map(parser, ['bad', 'bad', '2008-02-29', '2008-02-29']))
+    self.assertEqual(['bad', '2008-02-29'], parsed)
+
+  def test_fast_arc4_matches_arc4(self):
+    data = self._get_test_data("testdata.xml").encode('utf-8')
+    expected = ARC4(Constants.SECRET_KEY).crypt(data)
+    for use_numpy in (False, True):
+      if use_numpy and numpy is None:
+        continue
+      self.assertEqual(expected, FastARC4(Constants.SECRET_KEY, use_numpy=use_numpy).crypt(data))
+      # Decrypting in arbitrary pieces keeps the keystream in step
+      a = FastARC4(Constants.SECRET_KEY, use_numpy=use_numpy)
+      a.block_size = 100
+      pieces = a.crypt(memoryview(data)[:1000]) + a.crypt(bytearray(data[1000:]))
+      self.assertEqual(expected, pieces)
+
+  def test_columnar_export(self):
+    fixture = self._get_test_data("testdata.xml")
+    second = fixture.replace('<id>616</id>', '<id>617</id>').replace(
+      '<product_quantity>1</product_quantity>', '<product_quantity>3</product_quantity>')
+    export = export_transactions(FoxyData.from_str(fixture).transactions)
+    export.add(FoxyData.from_str(second).transactions)
+    self.assertEqual(['616', '617'], list(export.transactions['id']))
+    self.assertEqual([24.38, 24.38], list(export.transactions['order_total']))
+    self.assertEqual([0, 1], list(export.details['transaction']))
+    self.assertEqual(['abc123'], export.details['product_code'].values)
+    self.assertEqual([0, 1], list(export.options['detail']))
+    self.assertEqual({'abc123': 80.0}, revenue_by_product(export))
+    self.assertEqual({'2007-05-04': 2}, counts_by_date(export))
+    out = StringIO()
+    export.custom_fields.write_csv(out)
+    self.assertEqual(['transaction,name,value', '0,Another_Custom_Field,10',
+                      '0,My_Cool_Text,Value123'], out.getvalue().splitlines()[:3])
+
+  def test_cached_key_schedule(self):
+    data = self._get_test_data("testdata.xml").encode('utf-8')
+    for key in (Constants.SECRET_KEY, Constants.SECRET_KEY[::-1]):
+      expected = ARC4(key).crypt(data)
+      # Each cipher starts from its own copy of the cached schedule
+      a = FastARC4.for_key(key)
+      self.assertEqual(expected, a.crypt(data))
+      self.assertEqual(expected, FastARC4.for_key(key).crypt(data))
+      self.assertEqual(expected, FastARC4.for_key(unicode(key)).crypt(data))
+    self.assert_(str(Constants.SECRET_KEY) in FastARC4._schedules)
+    self.assert_(str(Constants.SECRET_KEY[::-1]) in FastARC4._schedules)
+
   # The following methods contain the tests that excersise your views code
   # You will need to provide captured data from the foxycart feed in order 
   # to test properly.  See the capture_foxyfeed view for data capture.
@@ -105,6 +314,527 @@ class FoxyDataVectorTest(unittest.TestCase):
                         "View for xmlfeed returned foxy for corrupted data")
 
 
+class FeedQueueTest(unittest.TestCase):
+  def setUp(self):
+    self.spool_path = tempfile.mktemp(suffix='.sqlite')
+
+  def tearDown(self):
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(self.spool_path + suffix):
+        os.remove(self.spool_path + suffix)
+
+  def test_replays_spool_of_dead_process(self):
+    dead = FeedSpool(self.spool_path, owner='%d-dead' % os.getpid())
+    dead.add('left behind')
+    # A live owner with the same pid keeps its rows
+    alive = FeedSpool(self.spool_path, owner='%d-alive' % os.getpid())
+    alive.add('in progress')
+    dead.db.execute("UPDATE feed_spool_owner SET heartbeat = 0 WHERE owner = ?", (dead.owner,))
+    processed = []
+    pool = FeedWorkerPool(processed.append, FeedSpool(self.spool_path), workers=1)
+    pool.recover().join()
+    self.assert_(pool.submit('new'))
+    pool.queue.join()
+    self.assertEqual(['left behind', 'new'], sorted(processed))
+    self.assertEqual(1, len(pool.spool))
+
+  def test_retries_and_exhausted(self):
+    calls = []
+    def process(payload):
+      calls.append(payload)
+      if payload == 'bad' or len(calls) < 2:
+        raise ValueError(payload)
+    sink = foxymetrics.MemorySink()
+    old = foxymetrics.set_sink(sink)
+    try:
+      pool = FeedWorkerPool(process, FeedSpool(self.spool_path), workers=1,
+                            max_attempts=3, retry_delay=0.01).start()
+      pool.submit('flaky')
+      pool.submit('bad')
+      deadline = time.time() + 5
+      while calls.count('bad') < 3 and time.time() < deadline:
+        time.sleep(0.01)
+      pool.join()
+    finally:
+      foxymetrics.set_sink(old)
+    self.assertEqual(2, calls.count('flaky'))
+    self.assertEqual(3, calls.count('bad'))
+    self.assertEqual(1, len(pool.spool))
+    self.assertEqual([3], [attempts for feed_id, received, attempts in pool.spool.exhausted(3)])
+    self.assertEqual([1], sink.values('datafeed.spool.exhausted'))
+
+  def test_backpressure(self):
+    release = threading.Event()
+    pool = FeedWorkerPool(lambda payload: release.wait(), FeedSpool(self.spool_path),
+                          workers=1, queue_size=1, put_timeout=0.01)
+    results = [pool.submit(str(i)) for i in range(4)]
+    release.set()
+    pool.join()
+    self.assertEqual([True, True, False, False], results)
+    self.assertEqual(0, len(pool.spool))
+
+
+class TransactionHandlerTest(unittest.TestCase):
+  def test_batched_dispatch(self):
+    small, large = [], []
+    small_handler = foxyhandlers.register(batch_size=2)(small.append)
+    large_handler = foxyhandlers.register(large.append)
+    try:
+      count = foxyhandlers.dispatch(iter(range(5)), batch_size=500)
+    finally:
+      foxyhandlers.unregister(small_handler)
+      foxyhandlers.unregister(large_handler)
+    self.assertEqual(5, count)
+    self.assertEqual([[0, 1], [2, 3], [4]], small)
+    self.assertEqual([[0, 1, 2, 3, 4]], large)
+    self.assertEqual([], [h for h, size in foxyhandlers.get_handlers()
+                          if h in (small_handler, large_handler)])
+
+
+class DeduplicatorTest(TestCase):
+  def _transactions(self, *ids):
+    transactions = []
+    for transaction_id in ids:
+      tx = FoxyData.Transaction()
+      tx.id = transaction_id
+      transactions.append(tx)
+    return transactions
+
+  def test_bloom_filter(self):
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+      bloom.add(str(i))
+    self.assert_(all(str(i) in bloom for i in range(1000)))
+    false_positives = len([i for i in range(1000, 11000) if str(i) in bloom])
+    self.assert_(false_positives < 300, false_positives)
+
+  def test_split_and_record(self):
+    dedup = TransactionDeduplicator(capacity=1000, error_rate=0.01)
+    new, duplicates = dedup.split(self._transactions('1', '2', '2'))
+    self.assertEqual(['1', '2'], [tx.id for tx in new])
+    self.assertEqual(['2'], [tx.id for tx in duplicates])
+    dedup.claim(new)
+
+    # A fresh instance warms up from the database
+    dedup = TransactionDeduplicator(capacity=1000, error_rate=0.01)
+    new, duplicates = dedup.split(self._transactions('1', '3'))
+    self.assertEqual(['3'], [tx.id for tx in new])
+    self.assertEqual(['1'], [tx.id for tx in duplicates])
+    self.assertEqual(1, dedup.stats['duplicates'])
+
+  def test_claims_are_shared_between_deduplicators(self):
+    # Two workers, both warmed up before either saw a transaction
+    first = TransactionDeduplicator(capacity=1000, error_rate=0.01)
+    second = TransactionDeduplicator(capacity=1000, error_rate=0.01)
+    first.warm_up()
+    second.warm_up()
+    new, duplicates = first.claim(self._transactions('1', '2'))
+    self.assertEqual(['1', '2'], [tx.id for tx in new])
+    new, duplicates = second.claim(self._transactions('2', '3'))
+    self.assertEqual(['3'], [tx.id for tx in new])
+    self.assertEqual(['2'], [tx.id for tx in duplicates])
+    self.assertEqual(1, second.stats['duplicates'])
+
+    # Released ids can be claimed again, by either of them
+    first.release(self._transactions('1'))
+    new, duplicates = second.claim(self._transactions('1', '3'))
+    self.assertEqual(['1'], [tx.id for tx in new])
+    self.assertEqual(['3'], [tx.id for tx in duplicates])
+    self.assertEqual(3, SeenTransaction.objects.count())
+
+
+class FoxyClientTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubFoxyServer().start()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_connections_are_reused(self):
+    client = FoxyClient(self.server.url, 'key', pool_size=2)
+    for i in range(10):
+      self.assertEqual(SUCCESS, client.call('attribute_save', {'name': 'n', 'value': str(i)}))
+    client.pool.close()
+    self.assertEqual(1, self.server.connections)
+    self.assertEqual('key', self.server.requests[0]['api_token'])
+    self.assertEqual('9', self.server.requests[-1]['value'])
+
+  def test_retries_server_errors(self):
+    failures = [(503, 'busy'), (500, 'oops')]
+    self.server.responses['category_list'] = \
+      lambda params: failures and failures.pop(0) or SUCCESS
+    client = FoxyClient(self.server.url, 'key', retries=2, backoff=0)
+    self.assertEqual(SUCCESS, client.call('category_list'))
+    self.assertEqual(3, len(self.server.requests))
+    client.pool.close()
+
+  def test_retries_other_actions_only_when_unsent(self):
+    self.server.responses['attribute_save'] = (503, 'busy')
+    client = FoxyClient(self.server.url, 'key', retries=2, backoff=0)
+    self.assertRaises(FoxyApiError, client.call, 'attribute_save')
+    self.assertEqual(1, len(self.server.requests))
+    self.assertRaises(FoxyApiError, client.call, 'attribute_save', idempotent=True)
+    self.assertEqual(4, len(self.server.requests))
+
+    # A kept-alive connection the server has since closed is retried on a new one
+    del self.server.responses['attribute_save']
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    stale = httplib.HTTPConnection('127.0.0.1', listener.getsockname()[1])
+    stale.connect()
+    listener.accept()[0].close()
+    listener.close()
+    client.pool.put(stale)
+    self.assertEqual(SUCCESS, client.call('attribute_save'))
+    self.assertEqual(5, len(self.server.requests))
+    client.pool.close()
+
+  def _transaction_list_page(self, params):
+    start = int(params['pagination_start'])
+    end = min(start + 1, 5)
+    transactions = ''.join(
+      '<transaction><id>%d</id><transaction_date>2012-01-0%d 10:00:00</transaction_date>'
+      '<customer_id>7</customer_id></transaction>' % (i, i) for i in range(start, end + 1))
+    return ('<?xml version="1.0" encoding="UTF-8"?><foxydata><result>SUCCESS</result>'
+            '<messages><message>Transactions Found</message></messages>'
+            '<statistics><total_orders>9</total_orders><filtered_total>5</filtered_total>'
+            '<pagination_start>%d</pagination_start><pagination_end>%d</pagination_end>'
+            '</statistics><transactions>%s</transactions></foxydata>' % (start, end, transactions))
+
+  def test_iter_list_follows_pagination(self):
+    self.server.responses['transaction_list'] = self._transaction_list_page
+    client = FoxyClient(self.server.url, 'key')
+    for prefetch in (False, True):
+      del self.server.requests[:]
+      transactions = list(iter_list(client, 'transaction_list',
+                                    {'customer_id_filter': '7'}, prefetch=prefetch, bufsize=50))
+      self.assertEqual(['1', '2', '3', '4', '5'], [tx.id for tx in transactions])
+      self.assertEqual(datetime(2012, 1, 5, 10), transactions[-1].date)
+      self.assertEqual(['1', '3', '5'], [r['pagination_start'] for r in self.server.requests])
+      self.assertEqual('7', self.server.requests[-1]['customer_id_filter'])
+    client.pool.close()
+
+  def test_iter_list_error(self):
+    self.server.responses['customer_list'] = (
+      '<?xml version="1.0" encoding="UTF-8"?><foxydata><result>ERROR</result>'
+      '<messages><message>Invalid Token</message></messages></foxydata>')
+    client = FoxyClient(self.server.url, 'key')
+    try:
+      list(iter_list(client, 'customer_list'))
+      self.fail('expected FoxyApiError')
+    except FoxyApiError, e:
+      self.assertEqual('Invalid Token', str(e))
+    client.pool.close()
+
+  def test_run_batch_keeps_input_order(self):
+    def slow_first(n):
+      if n == 0:
+        time.sleep(0.05)
+      if n == 3:
+        raise ValueError(n)
+      return n * 10
+    results = list(run_batch(slow_first, iter(range(6)), workers=3, max_pending=4))
+    self.assertEqual(range(6), [item for item, result, error in results])
+    self.assertEqual([0, 10, 20, None, 40, 50], [result for item, result, error in results])
+    self.assert_(isinstance(results[3][2], ValueError))
+
+  def test_parsed_responses(self):
+    self.server.responses['transaction_get'] = (
+      '<?xml version="1.0" encoding="UTF-8"?><foxydata><result>ERROR</result>'
+      '<messages><message>Transaction not found</message></messages></foxydata>')
+    client = FoxyClient(self.server.url, 'key')
+    response = client.request('transaction_get', {'transaction_id': '1'})
+    self.assertEqual('ERROR', response.status)
+    self.assertFalse(response.ok)
+    self.assertEqual(None, response._parser)
+    self.assertEqual(['Transaction not found'], response.messages)
+    self.assertRaises(FoxyApiError, response.raise_for_status)
+    self.assert_(client.request('attribute_save').raise_for_status().ok)
+    client.pool.close()
+
+    response = FoxyResponse('transaction_list',
+      '<foxydata><result>SUCCESS</result><transactions><transaction><id>5</id>'
+      '<customer_id>7</customer_id></transaction></transactions></foxydata>')
+    self.assertEqual(['5'], [t.id for t in response.records])
+    self.assertEqual('5', response.doc.getElementsByTagName('id')[0].firstChild.data)
+
+  def test_response_that_is_not_xml(self):
+    response = FoxyResponse('x', 'Service temporarily unavailable')
+    self.assertEqual('ERROR', response.status)
+    self.assertFalse(response.ok)
+    self.assertEqual([], response.records)
+    self.assert_('Service temporarily unavailable' in response.messages[0])
+    self.assertFalse(FoxyResponse('x', '<foxydata><transactions/></foxydata>').ok)
+
+    self.server.responses['attribute_save'] = (403, '<html><body>Forbidden</body></html>')
+    client = FoxyClient(self.server.url, 'key')
+    response = client.request('attribute_save')
+    self.assertEqual(403, response.http_status)
+    self.assertEqual('ERROR', response.status)
+    self.assert_('HTTP 403' in response.messages[0])
+    self.assertRaises(FoxyApiError, response.raise_for_status)
+    self.server.responses['attribute_save'] = (404, SUCCESS)
+    self.assertFalse(client.request('attribute_save').ok)
+    del self.server.responses['attribute_save']
+    response = client.request('attribute_save')
+    self.assertEqual(200, response.http_status)
+    self.assert_(response.ok)
+    client.pool.close()
+
+  def test_batch_reports_failed_calls(self):
+    self.server.responses['customer_get'] = (404, 'Not Found')
+    client = FoxyClient(self.server.url, 'key', retries=0)
+    batch = tempfile.NamedTemporaryFile()
+    batch.write('attribute_save name=n value=v type=customer identifier=1\n'
+                'customer_get customer_id=1\n')
+    batch.flush()
+    command = foxy_command.Command()
+    command.stdout = StringIO()
+    get_client, foxy_command.get_client = foxy_command.get_client, lambda: client
+    try:
+      self.assertRaises(CommandError, command.handle_batch, batch.name, 2, 0)
+    finally:
+      foxy_command.get_client = get_client
+      client.pool.close()
+    results = [json.loads(line) for line in command.stdout.getvalue().splitlines()]
+    self.assertEqual([('ok', 200), ('error', 404)],
+                     [(result['status'], result['http_status']) for result in results])
+
+  def test_response_cache(self):
+    def slow_list(params):
+      time.sleep(0.05)
+      return '<foxydata><result>SUCCESS</result><n>%d</n></foxydata>' % len(self.server.requests)
+    self.server.responses['category_list'] = slow_list
+    cache = ResponseCache(ttls={'category_list': 0.2}, stale_ttl=10)
+    client = FoxyClient(self.server.url, 'key', cache=cache)
+
+    # Concurrent misses share one request
+    bodies = []
+    threads = [threading.Thread(target=lambda: bodies.append(client.call('category_list')))
+               for i in range(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(1, len(self.server.requests))
+    self.assertEqual(set([bodies[0]]), set(bodies))
+    self.assert_('<n>1</n>' in bodies[0])
+
+    # Uncached actions and other arguments still go to the server
+    client.call('category_list', {'category_code': 'x'})
+    client.call('attribute_save')
+    self.assertEqual(3, len(self.server.requests))
+
+    # Stale entries are served while a single refresh runs
+    time.sleep(0.25)
+    self.assertEqual(bodies[0], client.call('category_list'))
+    self.assertEqual(bodies[0], client.call('category_list'))
+    time.sleep(0.1)
+    self.assertEqual(4, len(self.server.requests))
+    self.assert_('<n>4</n>' in client.call('category_list'))
+    client.pool.close()
+
+  def test_response_cache_skips_errors(self):
+    errors = ['<foxydata><result>ERROR</result></foxydata>',
+              (403, '<html><body>Forbidden</body></html>'), 'Service temporarily unavailable']
+    self.server.responses['category_list'] = lambda params: errors and errors.pop(0) or SUCCESS
+    client = FoxyClient(self.server.url, 'key', cache=ResponseCache())
+    self.assertEqual('ERROR', client.request('category_list').status)
+    self.assertEqual(403, client.request('category_list').http_status)
+    self.assertEqual('ERROR', client.request('category_list').status)
+    self.assertEqual('SUCCESS', response_status(client.call('category_list')))
+    response = client.request('category_list')
+    self.assertEqual((200, 'SUCCESS'), (response.http_status, response.status))
+    self.assertEqual(4, len(self.server.requests))
+    client.pool.close()
+
+
+class SubscriptionStoreTest(unittest.TestCase):
+  def _feed(self, *subscriptions):
+    return ''.join(
+      ['<?xml version="1.0" encoding="UTF-8"?><foxydata><subscriptions>'] +
+      ['<subscription><sub_token>%s</sub_token><customer_id>%s</customer_id>'
+       '<next_transaction_date>%s</next_transaction_date><frequency>1m</frequency>'
+       '<past_due_amount>%s</past_due_amount><is_active>%s</is_active>'
+       '<transaction_template><transaction_details><transaction_detail>'
+       '<product_code>%s</product_code></transaction_detail></transaction_details>'
+       '</transaction_template></subscription>' % s for s in subscriptions] +
+      ['</subscriptions></foxydata>'])
+
+  def test_indexes_and_queries(self):
+    data = FoxyData(self._feed(('a', '1', '2012-03-01', '0.00', '1', 'mag'),
+                               ('b', '1', '2012-03-05', '9.95', '1', 'box'),
+                               ('c', '2', '2012-03-20', '0.00', '1', 'mag'),
+                               ('d', '3', '2012-03-02', '0.00', '0', 'mag')))
+    self.assertEqual([], data.transactions)
+    store = SubscriptionStore(data.subscriptions)
+    tokens = lambda subscriptions: sorted(s.sub_token for s in subscriptions)
+    self.assertEqual(['a', 'b'], tokens(store.for_customer('1')))
+    self.assertEqual(['a', 'c', 'd'], tokens(store.for_product('mag')))
+    self.assertEqual(['a', 'b'], [s.sub_token for s in
+                                  store.due_within(7, today=datetime(2012, 2, 27))])
+    self.assertEqual(['a', 'b'], tokens(store.overdue(today=datetime(2012, 3, 10))))
+    self.assertEqual(['b'], tokens(store.past_due()))
+
+    # A later feed moves c forward and cancels a
+    store.upsert_all(FoxyData(self._feed(
+      ('c', '2', '2012-03-03', '0.00', '1', 'box'),
+      ('a', '1', '2012-03-01', '0.00', '0', 'mag'))).subscriptions)
+    self.assertEqual(['c', 'b'], [s.sub_token for s in
+                                  store.due_within(7, today=datetime(2012, 2, 27))])
+    self.assertEqual(['a', 'd'], tokens(store.for_product('mag')))
+    store.upsert(FoxyData(self._feed(
+      ('b', '1', '2012-04-05', '0.00', '1', 'box'))).subscriptions[0])
+    self.assertEqual(['c'], tokens(store.due_within(7, today=datetime(2012, 2, 27))))
+    self.assertEqual([], store.past_due())
+    self.assertEqual('b', store.remove('b').sub_token)
+    self.assertEqual(3, len(store))
+
+
+class MirrorSyncTest(TestCase):
+  def setUp(self):
+    self.server = StubFoxyServer({'transaction_list': self._page}).start()
+    self.client = FoxyClient(self.server.url, 'key', retries=0)
+    self.dates = ['2012-01-0%d 10:00:00' % i for i in range(1, 6)]
+    self.fail_at = None
+
+  def tearDown(self):
+    self.client.pool.close()
+    self.server.stop()
+
+  def _page(self, params):
+    # Two transactions per page, filtered on the date like the real API
+    start = int(params['pagination_start'])
+    if start == self.fail_at:
+      return (503, 'down')
+    begin = params.get('transaction_date_filter_begin', '')
+    matching = [(i + 1, date) for i, date in enumerate(self.dates) if date >= begin]
+    page = matching[start - 1:start + 1]
+    return ('<foxydata><result>SUCCESS</result><statistics>'
+            '<filtered_total>%d</filtered_total><pagination_start>%d</pagination_start>'
+            '<pagination_end>%d</pagination_end></statistics><transactions>%s'
+            '</transactions></foxydata>' % (
+              len(matching), start, start + len(page) - 1,
+              ''.join('<transaction><id>%d</id><transaction_date>%s</transaction_date>'
+                      '<customer_id>7</customer_id></transaction>' % t for t in page)))
+
+  def test_interrupted_and_delta_sync(self):
+    self.fail_at = 3
+    self.assertRaises(FoxyApiError, sync_transactions, self.client, batch_size=2)
+    state = SyncState.objects.get()
+    self.assertEqual(3, state.resume_start)
+    self.assertEqual(2, MirroredTransaction.objects.count())
+
+    # Resumes at the third transaction
+    self.fail_at = None
+    del self.server.requests[:]
+    self.assertEqual(3, sync_transactions(self.client, batch_size=2))
+    self.assertEqual('3', self.server.requests[0]['pagination_start'])
+    state = SyncState.objects.get()
+    self.assertEqual((1, datetime(2012, 1, 5, 10)), (state.resume_start, state.high_water))
+    self.assertEqual(5, MirroredTransaction.objects.count())
+
+    # Only the last day is downloaded again
+    self.dates.append('2012-01-06 09:00:00')
+    del self.server.requests[:]
+    self.assertEqual(2, sync_transactions(self.client, batch_size=2))
+    self.assertEqual('2012-01-05', self.server.requests[0]['transaction_date_filter_begin'])
+    self.assertEqual(6, MirroredTransaction.objects.count())
+    self.assertEqual(datetime(2012, 1, 6, 9), SyncState.objects.get().high_water)
+    self.assertEqual('7', MirroredTransaction.objects.get(transaction_id='6').customer_id)
+
+  def test_upsert_updates_existing_rows(self):
+    def transaction(transaction_id, customer_id):
+      tx = FoxyData.Transaction()
+      tx.id, tx.customer_id = transaction_id, customer_id
+      return tx
+    upsert_transactions([transaction('1', 'a'), transaction('2', 'a')])
+    upsert_transactions([transaction('2', 'b'), transaction('3', 'b')])
+    self.assertEqual([('1', 'a'), ('2', 'b'), ('3', 'b')], list(
+      MirroredTransaction.objects.order_by('transaction_id').values_list('transaction_id', 'customer_id')))
+
+
+class CaptureLogTest(unittest.TestCase):
+  def test_segments_and_replay_order(self):
+    directory = tempfile.mkdtemp()
+    log = CaptureLog(directory, segment_size=100)
+    feeds = ['\x00binary%d' % i * 5 for i in range(5)]
+    for i, feed in enumerate(feeds):
+      log.append(bytearray(feed), timestamp=1000 + i)
+    # The current segment is still open, as after a crash
+    self.assertEqual(list(enumerate(feeds, 1000)),
+                     [(int(t), crypted) for t, crypted in read_captures([directory])])
+    log.close()
+    self.assertEqual(3, len(os.listdir(directory)))
+    self.assertEqual(feeds, [crypted for t, crypted in read_captures([directory])])
+
+
+class FeedLimitsTest(unittest.TestCase):
+  def setUp(self):
+    self.markup = open(os.path.join(os.path.dirname(__file__), "fixtures",
+                                    "testdata.xml")).read()
+
+  def assertOverLimit(self, limit, func, *args, **kwargs):
+    try:
+      func(*args, **kwargs)
+    except FeedLimitExceeded, e:
+      self.assertEqual(limit, e.limit)
+    else:
+      self.fail("%s limit not enforced" % limit)
+
+  def test_parse_limits(self):
+    self.assertEqual(1, len(FoxyData(self.markup, limits=FeedLimits(1, 1, 8))))
+    self.assertOverLimit('transactions', FoxyData, self.markup,
+                         limits=FeedLimits(max_transactions=0))
+    self.assertOverLimit('depth', FoxyData, self.markup, limits=FeedLimits(max_depth=5))
+    # Also inside subtrees a projection skips
+    self.assertOverLimit('depth', FeedParser(['id'], FeedLimits(max_depth=5)).feed,
+                         self.markup, True)
+    bomb = ('<?xml version="1.0"?><!DOCTYPE foxydata [<!ENTITY a "aaaaaaaaaa">'
+            '<!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]><foxydata>&b;</foxydata>')
+    self.assertOverLimit('doctype', FoxyData, bomb, limits=FeedLimits())
+
+  def test_byte_limits(self):
+    crypted = ARC4(Constants.SECRET_KEY).crypt(self.markup)
+    self.assertOverLimit('bytes', FoxyData.from_crypted_str, crypted, Constants.SECRET_KEY,
+                         limits=FeedLimits(max_bytes=100))
+    stream = FoxyData.iter_transactions(StringIO(crypted), Constants.SECRET_KEY, bufsize=64,
+                                        limits=FeedLimits(max_bytes=100))
+    self.assertOverLimit('bytes', list, stream)
+    body = urllib.urlencode({'FoxyData': urllib.quote_plus(crypted)})
+    self.assertOverLimit('bytes', read_form_field, StringIO(body), 'FoxyData', 2,
+                         bufsize=64, max_size=100)
+
+  def test_view_rejects_large_feed(self):
+    body = urllib.urlencode({'FoxyData': urllib.quote_plus(
+      ARC4(settings.FOXYCART_DATAFEED_KEY).crypt(self.markup))})
+    request = RequestFactory().post('/foxycart/xmlfeed/', body,
+                                    content_type='application/x-www-form-urlencoded')
+    sink = foxymetrics.MemorySink()
+    old = foxymetrics.set_sink(sink)
+    settings.FOXYCART_DATAFEED_MAX_BYTES = 100
+    try:
+      response = views.foxyfeed(request)
+    finally:
+      del settings.FOXYCART_DATAFEED_MAX_BYTES
+      foxymetrics.set_sink(old)
+    self.assertEqual(413, response.status_code)
+    self.assertEqual([1], sink.values('datafeed.rejected.bytes'))
+
+
+class CommandSchemaTest(unittest.TestCase):
+  def test_validate_arguments(self):
+    self.assertEqual(frozenset(['name', 'value', 'type', 'identifier', 'append']),
+                     command_index['attribute_save'].allowed)
+    self.assertEqual(None, validate_arguments('transaction_get', {'transaction_id': '1'}))
+    self.assertEqual("command 'nope' not found.", validate_arguments('nope', {}))
+    self.assertEqual("required argument 'transaction_id' must be supplied.",
+                     validate_arguments('transaction_get', {}))
+    self.assertEqual("Unknown argument 'colour'",
+                     validate_arguments('category_list', {'colour': 'red'}))
+
+
 Constants.SECRET_KEY = 'abc123akp8ak7898a,.aoeueaouaoeuaoeu'
  
 if __name__ == '__main__':
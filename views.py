@@ -2,63 +2,169 @@
 Example Django view for receiving and decrypting datafeed.
 """
  
-import os
 import sys
-import codecs
  
 import urllib
 from django.http import *
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
  
-from foxyutils import FoxyData
+from foxyutils import FoxyData, FeedLimits, FeedLimitExceeded, read_form_field, PARALLEL_MIN_SIZE
+from foxyqueue import get_feed_pool
+from foxydedup import get_deduplicator, DuplicateFeedError
+from foxycapture import get_capture_log
+import foxyhandlers
+import foxymetrics
+import foxysubscriptions
+
+# Each byte of ciphertext is at most 5 bytes of body: FoxyCart url encodes
+# it ('%XX') and it is form encoded again ('%25XX').
+ENCODED_EXPANSION = 5
+
+def get_feed_limits():
+  """
+  FeedLimits from FOXYCART_DATAFEED_MAX_BYTES (of ciphertext),
+  FOXYCART_DATAFEED_MAX_TRANSACTIONS and FOXYCART_DATAFEED_MAX_DEPTH.
+  """
+  return FeedLimits(getattr(settings, 'FOXYCART_DATAFEED_MAX_BYTES', None),
+                    getattr(settings, 'FOXYCART_DATAFEED_MAX_TRANSACTIONS', None),
+                    getattr(settings, 'FOXYCART_DATAFEED_MAX_DEPTH', 32))
+
+def check_content_length(request, limits):
+  """
+  Refuse a body too long to hold limits.max_bytes of ciphertext before
+  any of it is read.
+  """
+  if limits.max_bytes is not None:
+    try:
+      length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+      length = 0
+    if length > limits.max_bytes * ENCODED_EXPANSION:
+      raise FeedLimitExceeded('bytes', length)
+
+def feed_limit_response(error):
+  foxymetrics.incr('datafeed.rejected.%s' % error.limit)
+  return HttpResponse('Error: datafeed over its %s limit.' % error.limit, status=413)
+
+def process_feed(payload, reject_duplicates = False):
+  """
+  Decrypt, parse and handle the transactions in a FoxyData payload as it
+  was posted (still url encoded).  Runs either inside the request or, in
+  async mode, on the foxyqueue worker pool.
+
+  With FOXYCART_DEDUP set, transactions handled before are skipped, and
+  DuplicateFeedError is raised if `reject_duplicates` is set and nothing
+  new is left.
+  """
+  foxymetrics.gauge('datafeed.payload_bytes', len(payload))
+  # IMPORTANT: unquote_plus is necessary for the non-ASCII binary that
+  # FoxyCart sends.
+  with foxymetrics.timer('datafeed.unquote'):
+    crypted = urllib.unquote_plus(payload)
+  return process_crypted_feed(crypted, reject_duplicates)
+
+def process_crypted_feed(crypted, reject_duplicates = False):
+  """
+  process_feed for a payload that has already been url decoded; `crypted`
+  may be a str, bytearray or memoryview.
+  """
+  data = FoxyData.from_crypted_str(
+    crypted, settings.FOXYCART_DATAFEED_KEY,
+    processes=getattr(settings, 'FOXYCART_PARSE_PROCESSES', 1),
+    min_size=getattr(settings, 'FOXYCART_PARSE_MIN_SIZE', PARALLEL_MIN_SIZE),
+    limits=get_feed_limits())
+  if data.subscriptions:
+    foxysubscriptions.get_store().upsert_all(data.subscriptions)
+  # Your code goes in a transaction handler, see foxyhandlers.  Handlers
+  # should verify the pricing of the products and add the order to the
+  # database; FOXYCART_DEDUP takes care of duplicate transaction ids.
+  transactions = data.transactions
+  deduplicator = get_deduplicator()
+  if deduplicator is not None:
+    transactions, duplicates = deduplicator.claim(transactions)
+    if duplicates and not transactions and reject_duplicates:
+      raise DuplicateFeedError("Duplicate transaction id %s" % duplicates[0].id)
+  try:
+    with foxymetrics.timer('datafeed.dispatch'):
+      foxyhandlers.dispatch(transactions)
+  except Exception:
+    # Unclaim them, so FoxyCart resending the feed isn't taken as a duplicate
+    if deduplicator is not None:
+      deduplicator.release(transactions)
+    raise
+  return data
+
+def read_crypted_payload(request, max_size = None):
+  """
+  The FoxyData ciphertext of a url encoded POST, read straight from the
+  request body instead of going through request.POST.  FoxyCart url
+  encodes the binary before form encoding it, so the field is decoded
+  twice, in one streaming pass, into a bytearray.  None if it is missing.
+  """
+  with foxymetrics.timer('datafeed.unquote'):
+    crypted = read_form_field(request, 'FoxyData', unquotes=2, max_size=max_size)
+  if crypted is not None:
+    foxymetrics.gauge('datafeed.payload_bytes', len(crypted))
+  return crypted
 
 @csrf_exempt
 def foxyfeed(request):
-  if request.POST and 'FoxyData' in request.POST:
-    try:
-      # IMPORTANT: unquote_plus is necessary for the non-ASCII binary that
-      # FoxyCart sends.
-      data = FoxyData.from_crypted_str(urllib.unquote_plus(request.POST['FoxyData']), settings.FOXYCART_DATAFEED_KEY)
-      for transaction in data.transactions:
-        # Your code goes here
-        # Make sure we don't have a duplicate transaction id
-        # Verify the pricing of the products
-        # Add the order to the database
-        pass
+  run_async = getattr(settings, 'FOXYCART_DATAFEED_ASYNC', False)
+  limits = get_feed_limits()
+  try:
+    check_content_length(request, limits)
+    if (request.method == 'POST' and not run_async and
+        request.META.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded')):
+      # Skip request.POST and its copies of the payload
+      with foxymetrics.timer('datafeed.total'):
+        crypted = read_crypted_payload(request, limits.max_bytes)
+        if crypted is not None:
+          if getattr(settings, 'FOXYCART_CAPTURE', False):
+            get_capture_log().append(crypted)
+          process_crypted_feed(memoryview(crypted), reject_duplicates=True)
+          return HttpResponse('foxy')
+
+    elif request.POST and 'FoxyData' in request.POST:
+      payload = request.POST['FoxyData'].encode('utf-8')
+      if getattr(settings, 'FOXYCART_CAPTURE', False):
+        get_capture_log().append(urllib.unquote_plus(payload))
+      if run_async:
+        # Persist the payload and acknowledge it right away; FoxyCart
+        # retries when the queue is too backed up to take it.
+        if not get_feed_pool(process_feed).submit(payload):
+          return HttpResponse('Error: datafeed queue is full.', status=503)
+      else:
+        with foxymetrics.timer('datafeed.total'):
+          process_feed(payload, reject_duplicates=True)
  
       return HttpResponse('foxy')
  
-    except Exception, e:
-	  # Something went wrong, handle the error...
-      raise
+  except DuplicateFeedError, e:
+    return HttpResponseForbidden('Error: duplicate transaction.')
+
+  except FeedLimitExceeded, e:
+    return feed_limit_response(e)
+
+  except Exception, e:
+    # Something went wrong, handle the error...
+    raise
  
   return HttpResponseForbidden('Unauthorized request.')  # No FoxyData?  Not a POST?  We don't speak that.
 
 @csrf_exempt
 def capture_foxyfeed(request):
-  capture_name = "test1"
-  save_request_object = True
-  allow_overwrite = False
-  capture_dir =  os.path.join(os.path.dirname(__file__), "fixtures")
-  if save_request_object:
-    capture_file_path = os.path.join(capture_dir, capture_name + '.request')
-    f = open(capture_file_path, 'w')
-    f.write(request.__repr__())
-    f.close()
-  if request.method == 'POST' and 'FoxyData' in request.POST:
-    encrypted_file_path = os.path.join(capture_dir, capture_name + '.encrypted')
-    plaintext_file_path = os.path.join(capture_dir, capture_name + '.plaintext')
-    if not allow_overwrite:
-      if os.path.exists(encrypted_file_path):
-          return HttpResponseForbidden('Error: data already captured.')
-
-    f = codecs.open(encrypted_file_path, encoding='utf-8', mode="w")
-    data = request.POST['FoxyData']
-    f.write(data)
-    f.close()
-    f = codecs.open(plaintext_file_path, encoding='utf-8', mode="w")
-    f.write(FoxyData.decrypt_str(urllib.unquote_plus(data), settings.FOXYCART_DATAFEED_KEY))
+  """
+  Append the datafeed to the capture log (see foxycapture) without
+  processing it.
+  """
+  try:
+    check_content_length(request, get_feed_limits())
+  except FeedLimitExceeded, e:
+    return feed_limit_response(e)
+  if request.POST and 'FoxyData' in request.POST:
+    payload = request.POST['FoxyData'].encode('utf-8')
+    get_capture_log().append(urllib.unquote_plus(payload))
     return HttpResponse('foxy')
  
   return HttpResponseForbidden('Unauthorized request.')